@@ -40,6 +40,10 @@ def create_app(config_class=Config):
     db.init_app(app)
     migrate.init_app(app, db)
     db.create_all(app=app)
+
+    # Spool uploaded files straight into the staging area
+    from app.util.im2db_utils import StagingRequest
+    app.request_class = StagingRequest
     # Initialise additional functionality
     login.init_app(app)
     mail.init_app(app)
@@ -63,8 +67,9 @@ def create_app(config_class=Config):
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
-    # Create directory to hold uploaded files
+    # Create directories to hold uploaded and staged files
     os.makedirs(app.config['UPLOADED_PATH'], exist_ok=True)
+    os.makedirs(app.config['STAGING_PATH'], exist_ok=True)
 
     # Actions in production mode
     if not app.debug:
@@ -1,5 +1,6 @@
 from flask_wtf import FlaskForm
 from wtforms import (
+    BooleanField,
     MultipleFileField,
     SelectField,
     SelectMultipleField,
@@ -20,14 +21,18 @@ class ImageUploadForm(FlaskForm):
 class ProcessTaskForm(FlaskForm):
     task_name = SelectField("Process Task")
     task_variable = StringField("optional command arguments")
+    force = BooleanField("Recompute even if an identical report exists")
     submit = SubmitField("Run task")
 
 
 # Select multiple Series and a Task
 class BatchProcessingForm(FlaskForm):
     task_name = RadioField()
+    # Tasks run together when the "protocol" task_name is selected
+    protocol_tasks = SelectMultipleField("Protocol tasks")
     many_series = SelectMultipleField()
     # task_variable = StringField(
     #     "optional command arguments", default="eg --measured_slice_width=3"
     # )
+    force = BooleanField("Recompute even if an identical report exists")
     submit = SubmitField("Run task on selected series")
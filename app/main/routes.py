@@ -1,25 +1,42 @@
 import os
 import shutil
+import uuid
 from datetime import datetime
 from importlib.metadata import version
 
-from flask import current_app, render_template, request, redirect
-from flask import url_for, session, flash
+from flask import current_app, render_template, request, redirect, jsonify
+from flask import Response, stream_with_context
+from flask import url_for, session, flash, abort
 from flask_login import current_user, login_required
+from werkzeug.utils import secure_filename
 
 from app import db
 from app.main import bp
 
 # make the blueprint independent of the application so that it is more portable
-from app.main.forms import ImageUploadForm, ProcessTaskForm, BatchProcessingForm
-from app.models import Image, Series, Study, Device, Task, Report
-from app.util.im2db_utils import upload_file, locate_image_files
+from app.main.forms import ProcessTaskForm, BatchProcessingForm
+from app.models import Image, Series, Study, Device, Task, Report, UploadBatch, BatchRun, Job
+from app.util.im2db_utils import upload_file, upload_files, receive_uploads, \
+    save_upload, stage_uploads, ingest_staged, queue_staged, receipt_json, \
+    locate_image_files, ImageExistsError
+from app.util.archive_import import is_archive, import_archive, queue_archive, ArchiveError
+from app.util.chunked_uploads import save_chunk, received_chunks, ChunkError
+from app.util.result_cache import cache_key, stored_content_hash, find_cached_report
+from app.util.events import events_enabled, event_stream
+from app.util.snr_pairing import pair_series, series_pairing_info
+from app.util.task_registry import get_task, UnknownTaskError
+from app.util.task_parameters import parse_task_variable, parameter_grid, ParameterError
+from app.util.batch_runs import create_batch_run, retry_batch_run, batch_run_progress, \
+    job_json, jobs_etag, PROTOCOL
 
 hazenlib_version = version("hazen")
 
 
 @bp.before_request
 def before_request():
+    # Uploads arrive one request per file, skip the extra commit for each
+    if request.endpoint == "main.upload":
+        return
     if current_user.is_authenticated:
         current_user.last_seen = datetime.utcnow()
         db.session.commit()
@@ -124,29 +141,10 @@ def workbench():
     # Save current user's ID to browser session
     session["current_user_id"] = current_user.id
 
-    # Display available image Series, grouped by Study UID
-    studies = db.session.query(Study).order_by(Study.created_at.desc())
-    # Collect device information about studies for display
-    study_device_list = [
-        {"study": study, "device": study.series[0].devices} for study in studies
-    ]
-
-    # Create Choose file form
-    upload_form = ImageUploadForm()
-
-    # List available tasks that can be performed
-    tasks = Task.query.all()
-    batch_form = BatchProcessingForm()
-    batch_form.task_name.choices = [task.name for task in tasks]
-
     if request.method == "POST":
         if "file" in request.files.keys():
-            # Uploaded by DropZone
-            dropzone_file = request.files.get("file")
-            # Most files in example dataset DO NOT HAVE an extension, can't check
-            # if dropzone_file.filename.split(".")[-1].lower() not in current_app.config['ALLOWED_EXTENSIONS']:
-            #     return 'incorrect file type', 400
-            upload_file(dropzone_file)
+            # Uploaded by DropZone, kept for clients still posting here
+            upload_file(request.files.get("file"))
 
         elif "submit" in request.form.keys():
             # Batch processing functionality
@@ -157,7 +155,7 @@ def workbench():
                 # Load which series were selected for which task
                 try:
                     task_name = request.form["task_name"]
-                    # task_variable = request.form["task_variable"]
+                    task_variable = request.form.get("task_variable")
                     selected_series = request.form.getlist("many_series")
                 except Exception as e:
                     flash(f"No task or image series were selected.", "info")
@@ -169,83 +167,369 @@ def workbench():
                     )
                     return redirect(url_for("main.workbench"))
 
-                # Create Celery jobs from batch processing request
-                celery_job_list = create_celery_jobs(
-                    user_id=current_user.id,
-                    series_ids=selected_series,
-                    task_name=task_name,
-                    # task_variable=task_variable,
-                )
-                job_ids = [job.id for job in celery_job_list]
-                msg = "The following jobs have been queued: " + ",".join(job_ids)
-                current_app.logger.info(msg)
-                flash(
-                    f"Processing of the {task_name} task has begun for {len(selected_series)} series",
-                    "success",
-                )
+                if task_name == PROTOCOL:
+                    # Several tasks run by a single job per series
+                    task_names = request.form.getlist("protocol_tasks")
+                    if len(task_names) == 0:
+                        flash("No tasks were selected for the protocol.", "info")
+                        return redirect(url_for("main.workbench"))
+                    batch_run = create_protocol_jobs(
+                        user_id=current_user.id,
+                        series_ids=selected_series,
+                        task_names=task_names,
+                        force="force" in request.form,
+                    )
+                    task_name = f"{PROTOCOL} ({', '.join(task_names)})"
+                else:
+                    # Create Celery jobs from batch processing request
+                    batch_run = create_celery_jobs(
+                        user_id=current_user.id,
+                        series_ids=selected_series,
+                        task_name=task_name,
+                        task_variable=task_variable,
+                        force="force" in request.form,
+                    )
+                if batch_run is not None:
+                    current_app.logger.info(f"Batch run {batch_run.id} has been queued")
+                    flash(
+                        f"Processing of the {task_name} task has begun for {len(selected_series)} series",
+                        "success",
+                    )
 
             # Upload file functionality
             else:
-                # Uploaded by Choose File
-                for choose_file in request.files.getlist("image_files"):
-                    upload_file(choose_file)
+                # Uploaded by Choose File, ingested as a single batch
+                upload_files(request.files.getlist("image_files"))
 
         return redirect(url_for("main.workbench"))
 
+    # Display available image Series, grouped by Study UID
+    studies = db.session.query(Study).order_by(Study.created_at.desc())
+    # Collect device information about studies for display
+    study_device_list = [
+        {"study": study, "device": study.series[0].devices} for study in studies
+    ]
+
+    # List available tasks that can be performed
+    tasks = Task.query.all()
+    batch_form = BatchProcessingForm()
+    batch_form.task_name.choices = [task.name for task in tasks]
+    batch_form.protocol_tasks.choices = [task.name for task in tasks]
+
+    # Files dropped on this page are counted against a single upload batch
+    upload_batch_id = uuid.uuid4().hex
+
     return render_template(
         "workbench.html",
         title="Workbench",
         study_device_list=study_device_list,
         batch_form=batch_form,  # , tasks=tasks,
+        upload_batch_id=upload_batch_id,
     )
     # , series=series, next_url=next_url, prev_url=prev_url
 
 
-def create_celery_jobs(user_id, task_name: str, series_ids: list, task_variable=None):
-    celery_job_list = []
-    from app.tasks import produce_report
+# Upload
+# Save and ingest a single file posted by DropZone, without rendering a page
+@bp.route("/upload", methods=["POST"])
+@login_required
+def upload():
+    if "file" not in request.files.keys() or not request.files["file"].filename:
+        return jsonify(error="No file was provided"), 400
+    file = request.files["file"]
+    # Most files in example dataset DO NOT HAVE an extension, can't check
+    # if file.filename.split(".")[-1].lower() not in current_app.config['ALLOWED_EXTENSIONS']:
+    #     return 'incorrect file type', 400
+
+    if current_app.config["INGEST_ASYNC"]:
+        # Only stage the file here, the Celery worker ingests it
+        try:
+            upload_batch_id = uuid.UUID(request.args.get("batch_id", uuid.uuid4().hex))
+        except ValueError:
+            return jsonify(error="Invalid upload batch ID"), 400
+        queued_response = jsonify(
+            upload_batch_id=upload_batch_id.hex,
+            status_url=url_for("main.upload_status", upload_batch_id=upload_batch_id.hex),
+        ), 202
+
+    if "dzuuid" in request.form:
+        # One chunk of a large file, ingested once all chunks have arrived
+        try:
+            staged_path = save_chunk(file, request.form)
+        except ChunkError as e:
+            return jsonify(error=str(e)), 400
+        except ImageExistsError:
+            return jsonify(filename=file.filename, duplicate=True)
+        if staged_path is None:
+            return jsonify(received_chunks(request.form["dzuuid"]))
+    elif is_archive(file.filename):
+        staged_path = save_upload(file)
+    else:
+        staged_path = None
+
+    if staged_path is not None and is_archive(file.filename):
+        # Archives are imported member by member
+        if current_app.config["INGEST_ASYNC"]:
+            queue_archive(staged_path, upload_batch_id, current_user.id)
+            return queued_response
+        try:
+            counts = import_archive(staged_path, current_user.id)
+        except ArchiveError as e:
+            return jsonify(filename=file.filename, error=str(e)), 400
+        finally:
+            os.remove(staged_path)
+        return jsonify(filename=file.filename, **counts)
+
+    if staged_path is not None:
+        staged = [(staged_path, secure_filename(file.filename))]
+        if current_app.config["INGEST_ASYNC"]:
+            queue_staged(staged, upload_batch_id, current_user.id)
+            return queued_response
+        receipt = ingest_staged(staged, current_user.id)[0]
+    elif current_app.config["INGEST_ASYNC"]:
+        stage_uploads([file], upload_batch_id, current_user.id)
+        return queued_response
+    else:
+        receipt = receive_uploads([file], current_user.id)[0]
+
+    if receipt["error"]:
+        return jsonify(receipt_json(receipt)), 400
+    return jsonify(receipt_json(receipt))
+
+
+# Chunked upload status
+# Chunks received so far, so that an interrupted upload can be resumed
+@bp.route("/upload/chunks/<upload_id>", methods=["GET"])
+@login_required
+def upload_chunks(upload_id):
+    try:
+        return jsonify(received_chunks(upload_id))
+    except ChunkError:
+        abort(404)
+
+
+# Upload status
+# Progress of an asynchronous upload batch
+@bp.route("/upload/<upload_batch_id>", methods=["GET"])
+@login_required
+def upload_status(upload_batch_id):
+    upload_batch = UploadBatch.get_by_id(upload_batch_id)
+    if upload_batch is None or upload_batch.user_id != current_user.id:
+        abort(404)
+    return jsonify(
+        upload_batch_id=upload_batch.id.hex,
+        staged=upload_batch.staged,
+        parsed=upload_batch.parsed,
+        duplicate=upload_batch.duplicate,
+        failed=upload_batch.failed,
+        pending=upload_batch.pending,
+        complete=upload_batch.pending == 0,
+    )
+
+
+# Job status
+# Recent jobs of the current user, polled with If-None-Match so that
+# unchanged job lists are answered with 304 Not Modified
+@bp.route("/jobs", methods=["GET"])
+@login_required
+def jobs():
+    query = Job.query.join(BatchRun).filter(BatchRun.user_id == current_user.id)
+    if request.args.get("status"):
+        query = query.filter(Job.status == request.args["status"])
+    if request.args.get("batch_run_id"):
+        batch_run = BatchRun.get_by_id(request.args["batch_run_id"])
+        query = query.filter(Job.batch_run_id == (batch_run.id if batch_run else None))
+    recent = query.with_entities(Job.id).order_by(Job.created_at.desc()).limit(
+        request.args.get("limit", 100, type=int)).subquery()
+    query = Job.query.join(recent, Job.id == recent.c.id).order_by(Job.created_at.desc())
+
+    etag = jobs_etag(query)
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(jobs=[job_json(job) for job in query])
+    response.set_etag(etag)
+    return response
+
+
+@bp.route("/jobs/<job_id>", methods=["GET"])
+@login_required
+def job_status(job_id):
+    job = Job.get_by_id(job_id)
+    if job is None or job.batch_run.user_id != current_user.id:
+        abort(404)
+    response = jsonify(job_json(job))
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+# Live job progress
+# Server-Sent Events stream of job state changes and new reports
+@bp.route("/events", methods=["GET"])
+@login_required
+def events():
+    if not events_enabled():
+        # 204 tells EventSource not to reconnect, pages keep polling instead
+        return "", 204
+    return Response(
+        stream_with_context(event_stream(current_user.id)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def find_existing_report(task_name, series_ids, task_kwargs=None):
+    """Report of an identical run on the same images, if already computed"""
+    image_hash = stored_content_hash(series_ids)
+    if image_hash is None:
+        return None
+    return find_cached_report(
+        cache_key(image_hash, task_name, task_kwargs, hazenlib_version))
+
+
+def find_existing_reports(task_name, series_ids, grid):
+    """Reports of identical runs for every parameter set, or None if any is missing"""
+    reports = [find_existing_report(task_name, series_ids, parameters) for parameters in grid]
+    return None if None in reports else reports
+
+
+def create_celery_jobs(user_id, task_name: str, series_ids: list, task_variable=None,
+                       force=False):
+    """Queue the jobs of a task over some series as one batch run
+
+    Optional arguments listing several values are swept: each job then
+    evaluates the task with every combination of values.
+
+    Returns:
+        BatchRun: the queued batch run, or None if nothing needed queueing
+    """
+    try:
+        grid = parameter_grid(parse_task_variable(task_variable, get_task(task_name)))
+    except (ParameterError, UnknownTaskError) as e:
+        flash(f"The {task_name} task could not be queued: {e}", "danger")
+        return None
+    # Per job, the series the report is attached to and the series processed
+    job_series = []
 
     # Check which task is requested
     if task_name == "snr":
-        if len(series_ids) < 2 or (len(series_ids) % 2) != 0:
+        # One job per pair of repeated acquisitions, reported on the first
+        pairs, unpaired = pair_series(series_pairing_info(series_ids),
+                                      current_app.config["SNR_PAIR_MAX_INTERVAL"])
+        if unpaired:
+            descriptions = [Series.get_by_id(series_id).description for series_id in unpaired]
             flash(
-                "Incorrect number of image series selected for SNR measurement", "info"
+                f"No matching acquisition was found for SNR measurement of: {', '.join(descriptions)}",
+                "info",
             )
-        else:
-            # TODO currently it is assumed that a single pair of images are selected
-            image_files = []
-            for series_id in series_ids:
-                # Identify selected series
-                series = Series.query.filter_by(id=series_id).first_or_404()
-                image_files.extend(locate_image_files(series.filesystem_key))
+        for pair in pairs:
+            reports = None if force else find_existing_reports(task_name, pair, grid)
+            if reports is not None:
+                flash(f"Reused the existing {task_name} report from "
+                      f"{reports[0].created_at.format('YYYY-MM-DD HH:mm')}", "info")
+                continue
             current_app.logger.info(
-                f"Performing {task_name} task on all images within series {series_ids}"
-            )
-            celery_job = produce_report.delay(
-                user_id=user_id,
-                series_id=series_ids[0],
-                task_name=task_name,
-                image_files=image_files,
+                f"Performing {task_name} task on all images within series {pair}"
             )
-            celery_job_list.append(celery_job)
+            job_series.append((pair[0], pair))
     else:
         # Set off a job per series
         for series_id in series_ids:
             # Identify selected series
             series = Series.query.filter_by(id=series_id).first_or_404()
-            image_files = locate_image_files(series.filesystem_key)
-            # Set off task processing as a Celery job
+            reports = None if force else find_existing_reports(task_name, [series.id], grid)
+            if reports is not None:
+                flash(f"Reused the existing {task_name} report for {series.description}", "info")
+                continue
             current_app.logger.info(
-                f"Performing {task_name} task on {len(image_files)} images within the {series_id} series"
-            )
-            celery_job = produce_report.delay(
-                user_id=user_id,
-                series_id=series_id,
-                task_name=task_name,
-                image_files=image_files,
+                f"Performing {task_name} task on the {series_id} series"
             )
-            celery_job_list.append(celery_job)
-    return celery_job_list
+            job_series.append((series.id, [series.id]))
+
+    if not job_series:
+        return None
+    # Set off task processing as a Celery chord
+    if len(grid) > 1:
+        return create_batch_run(user_id, task_name, job_series, force=force,
+                                parameter_grid=grid)
+    return create_batch_run(user_id, task_name, job_series, parameters=grid[0], force=force)
+
+
+def create_protocol_jobs(user_id, task_names: list, series_ids: list, force=False):
+    """Queue a job per series running all the tasks of a protocol
+
+    Series for which every task already has a report are skipped.
+
+    Returns:
+        BatchRun: the queued batch run, or None if nothing needed queueing
+    """
+    job_series = []
+    for series_id in series_ids:
+        series = Series.query.filter_by(id=series_id).first_or_404()
+        if not force and all(find_existing_report(task_name, [series.id])
+                             for task_name in task_names):
+            flash(f"Reused the existing {', '.join(task_names)} reports for {series.description}",
+                  "info")
+            continue
+        current_app.logger.info(
+            f"Performing {', '.join(task_names)} tasks on the {series_id} series"
+        )
+        job_series.append((series.id, [series.id]))
+
+    if not job_series:
+        return None
+    return create_batch_run(user_id, PROTOCOL, job_series, force=force,
+                            task_names=task_names)
+
+
+# Batch runs
+# Submit a task, or a protocol of several tasks, over many series and follow its progress
+@bp.route("/batch_runs", methods=["POST"])
+@login_required
+def batch_runs():
+    data = request.get_json(silent=True) or {}
+    task_name, series_ids = data.get("task_name"), data.get("series_ids")
+    task_names = data.get("task_names") if task_name == PROTOCOL else [task_name]
+    if not task_names or not series_ids or \
+            Task.query.filter(Task.name.in_(task_names)).count() != len(set(task_names)):
+        return jsonify(error="A task and at least one series are required"), 400
+    if task_name == PROTOCOL:
+        batch_run = create_protocol_jobs(
+            user_id=current_user.id,
+            series_ids=series_ids,
+            task_names=task_names,
+            force=bool(data.get("force")),
+        )
+    else:
+        batch_run = create_celery_jobs(
+            user_id=current_user.id,
+            series_ids=series_ids,
+            task_name=task_name,
+            task_variable=data.get("task_variable"),
+            force=bool(data.get("force")),
+        )
+    if batch_run is None:
+        return jsonify(error="No jobs were queued"), 400
+    return jsonify(batch_run_progress(batch_run)), 202
+
+
+@bp.route("/batch_runs/<batch_run_id>", methods=["GET"])
+@login_required
+def batch_run_status(batch_run_id):
+    batch_run = BatchRun.get_by_id(batch_run_id)
+    if batch_run is None or batch_run.user_id != current_user.id:
+        abort(404)
+    return jsonify(batch_run_progress(batch_run))
+
+
+@bp.route("/batch_runs/<batch_run_id>/retry", methods=["POST"])
+@login_required
+def batch_run_retry(batch_run_id):
+    batch_run = BatchRun.get_by_id(batch_run_id)
+    if batch_run is None or batch_run.user_id != current_user.id:
+        abort(404)
+    retry_batch_run(batch_run)
+    return jsonify(batch_run_progress(batch_run)), 202
 
 
 # Series overview
@@ -266,10 +550,10 @@ def series_view(series_id):
         form = ProcessTaskForm()
         # Provide list of available tasks that can be performed
         form.task_name.choices = [(task.name, task.name) for task in Task.query.all()]
-        series_files = Image.query.filter_by(series_id=series_id).count()
 
         # Store information about this series in a dict that can be passed to the html
         series_dict = {
+            "id": str(series.id),
             "description": series.description,
             "series_datetime": series.series_datetime,
             "created_at": series.created_at,
@@ -295,13 +579,16 @@ def series_view(series_id):
         #     print("No reports available for this user")
         # else:
 
-        # Group results by task_name --> dict { task: [results] }
+        # Group results by task_name and parameters --> dict { task: latest result }
         results_dict = {}
-        tasks = [report.task_name for report in reports]
-        for task in tasks:
-            task_result = Report.query.filter_by(  # user_id=user_id,
-                series_id=series_id, task_name=task
-            ).first_or_404()
+        for task_result in reports:
+            task = task_result.task_name
+            if task_result.parameters:
+                # Each parameter set of a sweep is shown separately
+                task += " (" + ", ".join(
+                    f"{name}={value}" for name, value in sorted(task_result.parameters.items())) + ")"
+            if task in results_dict:
+                continue
             # Find report images for series + task
             # directory = os.path.join(current_app.config['UPLOADED_PATH'],
             #                             )
@@ -330,28 +617,21 @@ def series_view(series_id):
         task_name = request.form["task_name"]
         task_variable = request.form["task_variable"]
         user_id = session["current_user_id"]
-        # Select files to perform task on
-        folder = os.path.join(
-            current_app.config["UPLOADED_PATH"], series.filesystem_key
-        )
-        image_files = [os.path.join(folder, file) for file in os.listdir(folder)]
-
-        # Ensure that appropriate number of files were selected
-        series_files = Image.query.filter_by(series_id=series.id).count()
-        if len(image_files) != series_files:
-            raise Exception("Number of files in directory is not equal to expected!")
 
         # Create Celery jobs from processing request
         current_app.logger.info(f"Performing {task_name} task on {series.description}")
-        celery_job_list = create_celery_jobs(
+        batch_run = create_celery_jobs(
             user_id=current_user.id,
             series_ids=[series.id],
             task_name=task_name,
             task_variable=task_variable,
+            force="force" in request.form,
         )
 
-        current_app.logger.info(f"Task performed successfully! \n")
-        flash(f"Completed {task_name} measurement!", "info")
+        if batch_run is not None:
+            current_app.logger.info(f"Batch run {batch_run.id} has been queued")
+            flash(f"The {task_name} measurement has been queued, "
+                  f"its results will appear below once complete", "info")
 
         # Passing task and series information to next page via Session dict
         session["task_name"] = task_name
@@ -40,6 +40,8 @@ class User(UserMixin, Model, SurrogatePK, CreatedTimestampMixin):
     # images = db.relationship('Image', back_populates='user')
     series = db.relationship('Series', back_populates='user')
     reports = db.relationship('Report', back_populates='user')
+    upload_batches = db.relationship('UploadBatch', back_populates='user')
+    batch_runs = db.relationship('BatchRun', back_populates='user')
 
     def avatar(self, size):
         digest = md5(self.email.lower().encode('utf-8')).hexdigest()
@@ -78,6 +80,8 @@ class Task(Model, SurrogatePK, CreatedTimestampMixin):  # Previously "ProcessTas
 
     # Column "id" is created automatically by SurrogatePK() from database.py
     name = db.Column(db.String(100), unique=True)  # TODO: Change from reading hazenlib modules to classes
+    cost_class = db.Column(db.String(20))  # Key of TASK_COST_CLASSES, setting its time limits
+    queue = db.Column(db.String(50))  # Celery queue the task is routed to
 
     # One-to-many relationship
     reports = db.relationship('Report', back_populates='task')
@@ -85,14 +89,19 @@ class Task(Model, SurrogatePK, CreatedTimestampMixin):  # Previously "ProcessTas
 
 class Image(Model, SurrogatePK, CreatedTimestampMixin):  # Previously "Acquisition"
     __tablename__ = "image"
+    __table_args__ = (
+        db.Index('ix_image_header', 'header', postgresql_using='gin'),
+        {'extend_existing': True})
 
     def __init__(self, **kwargs):
         db.Model.__init__(self, **kwargs)
 
     # Column "id" is created automatically by SurrogatePK() from database.py
-    uid = db.Column(db.String(100))  # DICOM SOP Instance UID (0008,0018)
+    uid = db.Column(db.String(100), index=True, unique=True)  # DICOM SOP Instance UID (0008,0018)
     filename = db.Column(db.String(200))
     accession_number = db.Column(db.String(100))  # DICOM Accession Number (0008,0050)
+    header = db.Column(JSONB)  # Normalised DICOM header snapshot, by keyword
+    checksum = db.Column(db.String(64))  # SHA-256 of the file, computed when first processed
     series_id = db.Column(db.ForeignKey('series.id'))
 
     # Many-to-one relationships
@@ -112,9 +121,10 @@ class Series(Model, SurrogatePK, CreatedTimestampMixin):
         db.Model.__init__(self, **kwargs)
 
     # Column "id" is created automatically by SurrogatePK() from database.py
-    uid = db.Column(db.String(64))  # DICOM Series UID (0020,000E)
+    uid = db.Column(db.String(64), index=True, unique=True)  # DICOM Series UID (0020,000E)
     description = db.Column(db.String(100))  # DICOM Series Description (0008,103E)
     series_datetime = db.Column(db.DateTime)  # DICOM Series Date and Series Time
+    acquisition = db.Column(JSONB)  # Acquisition parameters shared by the series, by keyword
     # These 2 make no sense to store, report can be looked up, archival doesn't help
     has_report = db.Column(db.Boolean, default=False)
     archived = db.Column(db.Boolean, default=False)
@@ -148,7 +158,7 @@ class Study(Model, SurrogatePK, CreatedTimestampMixin):
         db.Model.__init__(self, **kwargs)
 
     # Column "id" is created automatically by SurrogatePK() from database.py
-    uid = db.Column(db.String(64))  # DICOM Study UID (0020,000D)
+    uid = db.Column(db.String(64), index=True, unique=True)  # DICOM Study UID (0020,000D)
     description = db.Column(db.String(100))  # DICOM Study Description (0008,1030)
     study_date = db.Column(db.String(64))  # DICOM Study date (0008,0020)
 
@@ -158,6 +168,9 @@ class Study(Model, SurrogatePK, CreatedTimestampMixin):
 
 class Device(Model, SurrogatePK, CreatedTimestampMixin):
     __tablename__ = 'device'
+    __table_args__ = (
+        db.UniqueConstraint('institution', 'manufacturer', 'device_model',
+                            'station_name', name='uq_device_identity'),)
 
     def __init__(self, **kwargs):
         db.Model.__init__(self, **kwargs)
@@ -181,6 +194,10 @@ class Report(Model, SurrogatePK, CreatedTimestampMixin):
     # Column "id" is created automatically by SurrogatePK() from database.py
     hazen_version = db.Column(db.String(10))  # Hazenlib version
     data = db.Column(JSONB)  # Results
+    parameters = db.Column(JSONB)  # Task arguments
+    # Hash of the image content, task, parameters and hazen_version, cleared
+    # once the report no longer matches the installed hazenlib version
+    cache_key = db.Column(db.String(64), index=True)
 
     user_id = db.Column(db.ForeignKey('user.id'))
     series_id = db.Column(db.ForeignKey('series.id'))
@@ -194,3 +211,84 @@ class Report(Model, SurrogatePK, CreatedTimestampMixin):
     @hybrid_property
     def filesystem_key(self):
         return self.id.hex
+
+
+class UploadBatch(Model, SurrogatePK, CreatedTimestampMixin):
+    __tablename__ = "upload_batch"
+
+    def __init__(self, **kwargs):
+        db.Model.__init__(self, **kwargs)
+
+    # Column "id" is created automatically by SurrogatePK() from database.py
+    # Counts of files received and their ingest outcome
+    staged = db.Column(db.Integer, default=0, nullable=False)
+    parsed = db.Column(db.Integer, default=0, nullable=False)
+    duplicate = db.Column(db.Integer, default=0, nullable=False)
+    failed = db.Column(db.Integer, default=0, nullable=False)
+
+    user_id = db.Column(db.ForeignKey('user.id'))
+
+    # Many-to-one relationship
+    user = db.relationship('User', back_populates='upload_batches')
+
+    @hybrid_property
+    def pending(self):
+        return self.staged - self.parsed - self.duplicate - self.failed
+
+
+class BatchRun(Model, SurrogatePK, CreatedTimestampMixin):
+    __tablename__ = "batch_run"
+
+    def __init__(self, **kwargs):
+        db.Model.__init__(self, **kwargs)
+
+    # Column "id" is created automatically by SurrogatePK() from database.py
+    task_name = db.Column(db.ForeignKey('task.name'))  # Unset for protocol runs
+    task_names = db.Column(JSONB)  # Tasks of a protocol run, each job runs them all
+    parameters = db.Column(JSONB)  # Task arguments shared by all jobs
+    parameter_grid = db.Column(JSONB)  # Task arguments of a sweep run, each job evaluates them all
+    force = db.Column(db.Boolean, default=False)  # Recompute cached reports
+    finished_at = db.Column(db.DateTime)  # Set by the Celery chord callback, or the last job
+
+    user_id = db.Column(db.ForeignKey('user.id'))
+
+    # One-to-many relationship
+    jobs = db.relationship('Job', back_populates='batch_run', lazy='dynamic')
+
+    # Many-to-one relationship
+    user = db.relationship('User', back_populates='batch_runs')
+
+
+class Job(Model, SurrogatePK, CreatedTimestampMixin):
+    __tablename__ = "job"
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, **kwargs):
+        db.Model.__init__(self, **kwargs)
+
+    # Column "id" is created automatically by SurrogatePK() from database.py
+    task_name = db.Column(db.String(100))
+    status = db.Column(db.String(20), default=QUEUED, nullable=False, index=True)
+    celery_id = db.Column(db.String(36), index=True)  # Celery task ID
+    series_ids = db.Column(JSONB)  # Series whose images are processed
+    enqueued_at = db.Column(db.DateTime)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    worker = db.Column(db.String(200))  # Hostname of the Celery worker
+    runtime = db.Column(db.Float)  # Seconds from start to finish
+    traceback = db.Column(db.Text)  # Error traceback of a failed job
+    cache_hits = db.Column(db.Integer)  # Datasets read from the worker's dataset cache
+    cache_misses = db.Column(db.Integer)  # Datasets read from disk
+
+    batch_run_id = db.Column(db.ForeignKey('batch_run.id'), index=True)
+    series_id = db.Column(db.ForeignKey('series.id'))  # Series the report is attached to
+    report_id = db.Column(db.ForeignKey('report.id'))  # Report produced or reused
+
+    # Many-to-one relationships
+    batch_run = db.relationship('BatchRun', back_populates='jobs')
+    series = db.relationship('Series')
+    report = db.relationship('Report')
@@ -0,0 +1,32 @@
+// SHA-256 checksums of upload chunks, sent with each chunk and verified by the
+// server before the chunk is kept (see app/util/chunked_uploads.py)
+
+// Web Crypto is only available in secure contexts, pages served over plain
+// HTTP use the js-sha256 library loaded alongside this script instead
+async function sha256Hex(buffer) {
+    if (!(window.crypto && crypto.subtle)) return sha256(buffer);
+    const digest = await crypto.subtle.digest('SHA-256', buffer);
+    return Array.from(new Uint8Array(digest), (byte) => byte.toString(16).padStart(2, '0')).join('');
+}
+
+// Dropzone accept option, checksumming the chunks of a file before it is queued.
+// Files no larger than a chunk are sent whole, without chunk fields
+function checksumChunks(chunkSize) {
+    return function (file, done) {
+        if (file.size <= chunkSize) return done();
+        (async () => {
+            file.chunkChecksums = [];
+            for (let start = 0; start < file.size; start += chunkSize) {
+                const buffer = await file.slice(start, start + chunkSize).arrayBuffer();
+                file.chunkChecksums.push(await sha256Hex(buffer));
+            }
+        })().then(() => done(), (error) => done('Could not checksum ' + file.name + ': ' + error));
+    };
+}
+
+// Dropzone params option, adding the checksum of each chunk to its form fields
+function chunkParams(files, xhr, chunk) {
+    const params = Dropzone.prototype.defaultOptions.params.call(this, files, xhr, chunk) || {};
+    if (chunk) params.chunk_checksum = chunk.file.chunkChecksums[chunk.index];
+    return params;
+}
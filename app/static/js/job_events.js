@@ -0,0 +1,73 @@
+// Live job progress, pushed by the server as Server-Sent Events (see main.events)
+
+const JOB_STATUS_CLASSES = {queued: 'secondary', running: 'primary', done: 'success', failed: 'danger'};
+
+// Show or update the status line of a job in a container element
+function showJobStatus(container, job) {
+    let line = document.getElementById('job-' + job.job_id);
+    if (!line) {
+        line = document.createElement('div');
+        line.id = 'job-' + job.job_id;
+        line.setAttribute('role', 'status');
+        container.appendChild(line);
+    }
+    line.className = 'alert alert-' + (JOB_STATUS_CLASSES[job.status] || 'info') + ' text-center py-1';
+    let text = job.task_name + ' job ' + job.status;
+    if (job.worker) text += ' on ' + job.worker;
+    if (job.runtime !== null) text += ' in ' + job.runtime.toFixed(1) + 's';
+    line.textContent = text;
+}
+
+// Listen for job, report and batch run events, with a handler per event type.
+// Without Server-Sent Events, or once the server closes the stream, the job
+// list at pollUrl is polled instead (see main.jobs)
+function listenForJobEvents(url, handlers, pollUrl) {
+    if (!window.EventSource) return pollJobEvents(pollUrl, handlers);
+    const source = new EventSource(url);
+    for (const [event, handler] of Object.entries(handlers)) {
+        source.addEventListener(event, (message) => handler(JSON.parse(message.data)));
+    }
+    // A closed stream is not reconnected, such as the 204 sent when events are disabled
+    source.addEventListener('error', () => {
+        if (source.readyState === EventSource.CLOSED) pollJobEvents(pollUrl, handlers);
+    });
+    return source;
+}
+
+const JOB_POLL_INTERVAL = 5000;  // milliseconds
+
+// Call the job handler for jobs whose status changed since the page loaded,
+// and the report handler for the reports of jobs that are done
+function pollJobEvents(url, handlers) {
+    const statuses = {};
+    let etag = null;
+    let loaded = false;
+    async function poll() {
+        try {
+            // Unchanged job lists are answered with 304 Not Modified
+            const response = await fetch(url, {
+                cache: 'no-store', headers: etag ? {'If-None-Match': etag} : {}});
+            if (response.ok) {
+                etag = response.headers.get('ETag');
+                const {jobs} = await response.json();
+                // Oldest first, as the events would have arrived
+                for (const job of jobs.reverse()) {
+                    const changed = loaded && statuses[job.job_id] !== job.status;
+                    statuses[job.job_id] = job.status;
+                    if (!changed) continue;
+                    if (handlers.job) handlers.job(job);
+                    if (handlers.report && job.status === 'done' && job.report_id) {
+                        handlers.report({report_id: job.report_id, series_id: job.series_id,
+                                         task_name: job.task_name});
+                    }
+                }
+                loaded = true;
+            }
+        } catch (error) {
+            console.warn('Could not poll jobs:', error);
+        }
+        setTimeout(poll, JOB_POLL_INTERVAL);
+    }
+    poll();
+    return null;
+}
@@ -1,66 +1,211 @@
 """Tasks module, specifying Hazen-related tasks and utilities."""
 
-import importlib
-import inspect
+import math
 import os
-import sys
 import shutil
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from importlib.metadata import version
 
 from flask import current_app, jsonify, make_response
 
 from app import db
-from app.models import Report, Series
-from hazen import worker
+from app.models import Report, Series, BatchRun, Job
+from app.util.im2db_utils import ingest_staged, update_upload_batch, count_receipts, \
+    resolve_image_files, remove_staged
+from app.util.archive_import import import_archive
+from app.util.chunked_uploads import expire_partial_uploads
+from app.util.task_registry import get_task, load_task_registry
+from app.util.result_cache import cache_key, files_content_hash, find_cached_report, \
+    invalidate_stale_reports
+from app.util.batch_runs import update_job, batch_run_progress, routing_options, \
+    chords_supported, finish_if_complete
+from app.util.events import publish_event
+from app.util.dataset_cache import install_dataset_cache, dataset_cache
+from hazen import app, worker
+from celery import chord
+from celery.signals import worker_init, task_prerun, task_postrun
 from celery.utils.log import get_task_logger
 
 logger = get_task_logger(__name__)
 
+# Status of the report referenced by the result of a job
+CREATED = 'created'
+CACHED = 'cached'
+
+
+@worker_init.connect
+def preload_hazen_tasks(**kwargs):
+    """Import the hazenlib tasks in the worker parent, before the pool forks"""
+    with app.app_context():
+        load_task_registry()
+        install_dataset_cache(current_app.config)
+        # Reports of another hazenlib version are no longer reused
+        invalidated = invalidate_stale_reports(version('hazen'))
+        if invalidated:
+            logger.info(f"{invalidated} cached reports invalidated")
+
+
 @worker.task(bind=True)
-def produce_report(self, user_id, series_id, task_name, image_files,
-                  **kwargs):
+def produce_report(self, user_id, series_id, task_name, series_ids,
+                   manifest_version=None, force=False, job_id=None, **kwargs):
     logger.info("produce report")
-    # import Hazen functionality
-    task_module = importlib.import_module(f"hazenlib.tasks.{task_name}")
-    logger.info(f"Performing {task_name} task on {series_id}")
+    # Look up Hazen functionality, raises UnknownTaskError for unknown tasks
+    registered_task = get_task(task_name)
+    # Files are listed here, from the Image rows of the series, so that the
+    # message stays small and this node's own UPLOADED_PATH is used
+    image_files = resolve_image_files(series_ids, manifest_version)
+
+    # Reuse the report of an identical run, unless asked to recompute
+    hazen_version = version('hazen')
+    key = cache_key(files_content_hash(image_files), task_name, kwargs, hazen_version)
+    # Keep the image checksums even if the task fails
+    db.session.commit()
+    cached_report = None if force else find_cached_report(key)
+    if cached_report is not None:
+        logger.info(f"Reusing report {cached_report.id} for {task_name} on {series_id}")
+        return report_reference(cached_report.id, CACHED)
 
-    # Update Celery task status
-    self.update_state(state='PENDING')
+    chunk_size = registered_task.chunk_size
+    # Without chord support, such as with the rpc:// backend, series are not split
+    if chunk_size and len(image_files) > chunk_size and chords_supported(self.app):
+        # Replaced by chunks run in parallel, merged into the report by a chord
+        logger.info(f"Splitting {task_name} task on {series_id} into chunks of {chunk_size} images")
+        options = routing_options(task_name)
+        # The chunk images of this run are kept apart from those of identical runs
+        run_id = self.request.id
+        chunks = [produce_report_chunk.s(
+            task_name, series_id, series_ids, manifest_version, run_id, index, **kwargs
+        ).set(**options) for index in range(math.ceil(len(image_files) / chunk_size))]
+        merge = merge_report_chunks.s(
+            user_id=user_id, series_id=series_id, task_name=task_name, key=key,
+            parameters=kwargs, run_id=run_id, job_id=job_id).set(**options)
+        return self.replace(chord(chunks, merge))
+    logger.info(f"Performing {task_name} task on {series_id}")
 
-    # Pass image file path and variables to Hazenlib task
-    try:
-        task = getattr(task_module, task_name.capitalize())(
-            input_data=image_files, report=True, **kwargs)
-    except:
-        class_list = [cls.__name__ for _, cls in inspect.getmembers(
-            sys.modules[task_module.__name__],
-            lambda x: inspect.isclass(x) and (x.__module__ == task_module.__name__)
-            )]
-        if len(class_list) == 1:
-            task = getattr(task_module, class_list[0])(
-            input_data=image_files, report=True, **kwargs)
-            logger.info(task)
-        else:
-            raise Exception(
-                f'Task {task_module} has multiple class definitions: {class_list}')
+    # Pass image file path and variables to Hazenlib task, those of its
+    # run() method are passed when running it
+    init_kwargs, run_kwargs = registered_task.split_kwargs(kwargs)
+    task = registered_task.create(image_files, **init_kwargs)
 
     # Perform task and generate result
     logger.info(f"running task: {task}")
-    result_dict = task.run()
+    cache = dataset_cache()
+    counts_before = cache.counts() if cache else None
+    result_dict = task.run(**run_kwargs)
+    cache_counts = cache_counts_since(cache, counts_before) if cache else None
+    if cache:
+        logger.info(f"Dataset cache: {cache_counts}")
 
     logger.info(result_dict)
     # measurement = json.dumps(result_dict['measurement'])
 
-    # Update Celery task status
-    self.update_state(state='SUCCESS')
-
     # Store task result in the Report table
+    report = save_report(result_dict, hazen_version, key, kwargs,
+                         user_id, series_id, task_name)
+
+    # Update the has_report field of the corresponding Series
+    series = Series.query.filter_by(id=series_id).first_or_404()
+    series.update(has_report=True)
+    # Commit all changes to the database
+    db.session.commit()
+
+    logger.info("db updated")
+    publish_event(user_id, 'report', {
+        'report_id': str(report.id), 'series_id': str(series_id), 'task_name': task_name})
+    return report_reference(report.id, CREATED, cache_counts)
+
+
+def chunk_report_dir(series_id, run_id):
+    """Folder of the report images of the chunks of a task run, until merged"""
+    return os.path.join(current_app.config['UPLOADED_PATH'], 'chunks',
+                        uuid.UUID(str(series_id)).hex, run_id)
+
+
+@worker.task
+def produce_report_chunk(task_name, series_id, series_ids, manifest_version, run_id, index,
+                         **kwargs):
+    """Map step, run a task on the images of one chunk of its series
+
+    Errors are returned rather than raised, so that the merge step fails the
+    job with them instead of leaving it running.
+    """
+    registered_task = get_task(task_name)
+    start = index * registered_task.chunk_size
+    stop = start + registered_task.chunk_size
+    try:
+        image_files = resolve_image_files(series_ids, manifest_version)[start:stop]
+        cache = dataset_cache()
+        counts_before = cache.counts() if cache else None
+        result_dict = registered_task.execute(
+            image_files, report_dir=chunk_report_dir(series_id, run_id), **kwargs)
+        partial = {'measurement': result_dict['measurement'],
+                   'report_image': result_dict['report_image']}
+        if cache:
+            partial['dataset_cache'] = cache_counts_since(cache, counts_before)
+        return partial
+    except Exception:
+        logger.exception(f"{task_name} task failed on images {start} to {stop}")
+        return {'error': traceback.format_exc()}
+
+
+@worker.task
+def merge_report_chunks(partials, user_id, series_id, task_name, key, parameters, run_id,
+                        job_id=None):
+    """Reduce step, merge the results of the chunks of a task into a single Report"""
+    try:
+        errors = [partial['error'] for partial in partials if 'error' in partial]
+        if errors:
+            raise RuntimeError(f"{len(errors)} of {len(partials)} chunks of the {task_name} "
+                               f"task failed, the first with:\n{errors[0]}")
+        result_dict = get_task(task_name).merge(partials)
+        report = save_report(result_dict, version('hazen'), key, parameters,
+                             user_id, series_id, task_name)
+        series = Series.query.filter_by(id=series_id).first_or_404()
+        series.update(has_report=True)
+        db.session.commit()
+    finally:
+        shutil.rmtree(chunk_report_dir(series_id, run_id), ignore_errors=True)
+
+    logger.info("db updated")
+    publish_event(user_id, 'report', {
+        'report_id': str(report.id), 'series_id': str(series_id), 'task_name': task_name})
+    counts = [partial['dataset_cache'] for partial in partials if 'dataset_cache' in partial]
+    cache_counts = {name: sum(count[name] for count in counts)
+                    for name in counts[0]} if counts else None
+    return report_reference(report.id, CREATED, cache_counts)
+
+
+def report_reference(report_id, status, cache_counts=None):
+    """Result of a job, the report itself is read from the database
+
+    Args:
+        report_id: ID of the report produced or reused
+        status (str): CREATED or CACHED
+        cache_counts (dict, optional): dataset cache hits and misses of the
+            job. Defaults to None.
+    """
+    reference = {'report_id': str(report_id), 'status': status}
+    if cache_counts:
+        reference['dataset_cache'] = cache_counts
+    return reference
+
+
+def save_report(result_dict, hazen_version, key, parameters, user_id, series_id, task_name):
+    """Add the Report of a task result to the session and store its images
+
+    The report is committed by the caller.
+    """
     report = Report(
-        hazen_version=version('hazen'), data=result_dict['measurement'],
+        hazen_version=hazen_version, data=result_dict['measurement'],
+        parameters=parameters, cache_key=key,
         user_id=user_id, series_id=series_id,
-        task_name=task_name)  #  task_variable=task_variable
-    # Save information to database
-    report.save()
+        task_name=task_name)
+    db.session.add(report)
+    # Assigns the report ID
+    db.session.flush()
 
     basedir = os.path.abspath(os.path.dirname(__file__))
     static_dir = os.path.join(basedir, 'static',
@@ -80,12 +225,260 @@ def produce_report(self, user_id, series_id, task_name, image_files,
         print(f"file copied to {static_path}")
         permanent_path = os.path.join(directory, filename)
         shutil.move(file, permanent_path)
+    return report
 
-    # Update the has_report field of the corresponding Series
+
+@worker.task(bind=True)
+def produce_protocol_reports(self, user_id, series_id, task_names, series_ids,
+                             manifest_version=None, force=False, job_id=None):
+    """Run several hazenlib tasks over the same series, loading it once
+
+    The series is read into the worker's dataset cache before the tasks run,
+    one after another or in PROTOCOL_THREADS threads sharing the cached
+    datasets. The reports of all tasks are stored in a single transaction,
+    so nothing is stored if any task fails.
+    """
+    registered_tasks = [get_task(task_name) for task_name in task_names]
+    image_files = resolve_image_files(series_ids, manifest_version)
+
+    hazen_version = version('hazen')
+    image_hash = files_content_hash(image_files)
+    db.session.commit()
+    keys = {task_name: cache_key(image_hash, task_name, {}, hazen_version)
+            for task_name in task_names}
+    reports, pending = {}, []
+    for registered_task in registered_tasks:
+        cached_report = None if force else find_cached_report(keys[registered_task.name])
+        if cached_report is not None:
+            logger.info(f"Reusing report {cached_report.id} for {registered_task.name} on {series_id}")
+            reports[registered_task.name] = report_reference(cached_report.id, CACHED)
+        else:
+            pending.append(registered_task)
+    if not pending:
+        return {'reports': reports}
+
+    cache, counts_before = load_series(image_files)
+
+    def run_task(registered_task):
+        logger.info(f"Performing {registered_task.name} task on {series_id}")
+        return registered_task.execute(image_files)
+
+    threads = current_app.config['PROTOCOL_THREADS']
+    if threads > 1 and len(pending) > 1:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = list(executor.map(run_task, pending))
+    else:
+        results = [run_task(registered_task) for registered_task in pending]
+
+    for registered_task, result_dict in zip(pending, results):
+        report = save_report(result_dict, hazen_version, keys[registered_task.name], {},
+                             user_id, series_id, registered_task.name)
+        reports[registered_task.name] = report_reference(report.id, CREATED)
     series = Series.query.filter_by(id=series_id).first_or_404()
-    series.update(has_report=True)
-    # Commit all changes to the database
+    series.update(commit=False, has_report=True)
+    db.session.commit()
+    logger.info("db updated")
+
+    for task_name, report in reports.items():
+        if report['status'] == CREATED:
+            publish_event(user_id, 'report', {
+                'report_id': report['report_id'], 'series_id': str(series_id),
+                'task_name': task_name})
+    result = {'reports': reports}
+    if cache:
+        result['dataset_cache'] = cache_counts_since(cache, counts_before)
+    return result
+
+
+@worker.task(bind=True)
+def produce_sweep_reports(self, user_id, series_id, task_name, series_ids, parameter_grid,
+                          manifest_version=None, force=False, job_id=None):
+    """Run a task over a grid of parameter sets, loading the series once
+
+    Each parameter set is evaluated on the datasets cached when the series is
+    loaded, and its result stored as a Report with those parameters. The
+    reports are stored in a single transaction.
+    """
+    registered_task = get_task(task_name)
+    image_files = resolve_image_files(series_ids, manifest_version)
+
+    hazen_version = version('hazen')
+    image_hash = files_content_hash(image_files)
     db.session.commit()
+    reports, pending = [], []
+    for parameters in parameter_grid:
+        key = cache_key(image_hash, task_name, parameters, hazen_version)
+        cached_report = None if force else find_cached_report(key)
+        if cached_report is not None:
+            reports.append({'parameters': parameters,
+                            **report_reference(cached_report.id, CACHED)})
+        else:
+            pending.append((parameters, key))
+    if not pending:
+        return {'reports': reports}
 
+    cache, counts_before = load_series(image_files)
+    stored = []
+    for parameters, key in pending:
+        logger.info(f"Performing {task_name} task on {series_id} with {parameters}")
+        result_dict = registered_task.execute(image_files, **parameters)
+        report = save_report(result_dict, hazen_version, key, parameters,
+                             user_id, series_id, task_name)
+        stored.append(str(report.id))
+        reports.append({'parameters': parameters, **report_reference(report.id, CREATED)})
+    series = Series.query.filter_by(id=series_id).first_or_404()
+    series.update(commit=False, has_report=True)
+    db.session.commit()
     logger.info("db updated")
-    return result_dict
+
+    for report_id in stored:
+        publish_event(user_id, 'report', {
+            'report_id': report_id, 'series_id': str(series_id), 'task_name': task_name})
+    result = {'reports': reports}
+    if cache:
+        result['dataset_cache'] = cache_counts_since(cache, counts_before)
+    return result
+
+
+def load_series(image_files):
+    """Read the files of a series into the dataset cache, before running several tasks
+
+    Returns:
+        tuple: the dataset cache, or None if disabled, and its counts beforehand
+    """
+    cache = dataset_cache()
+    if cache is None:
+        logger.warning("The dataset cache is disabled, each task run reads the series again")
+        return None, None
+    counts_before = cache.counts()
+    for file_path in image_files:
+        cache.read(file_path)
+    return cache, counts_before
+
+
+def cache_counts_since(cache, counts_before):
+    # Datasets read by this job, the cache is shared by the jobs of the process
+    counts = cache.counts()
+    return {name: counts[name] - counts_before[name] for name in counts}
+
+
+@task_prerun.connect(sender=produce_report)
+@task_prerun.connect(sender=produce_protocol_reports)
+@task_prerun.connect(sender=produce_sweep_reports)
+def job_started(task=None, kwargs=None, **extra):
+    if kwargs and kwargs.get('job_id'):
+        with app.app_context():
+            update_job(kwargs['job_id'], Job.RUNNING, worker=task.request.hostname)
+
+
+@task_postrun.connect(sender=produce_report)
+@task_postrun.connect(sender=produce_protocol_reports)
+@task_postrun.connect(sender=produce_sweep_reports)
+@task_postrun.connect(sender=merge_report_chunks)
+def job_finished(kwargs=None, retval=None, state=None, **extra):
+    # Jobs replaced by chunks are finished by their merge step
+    if not kwargs or not kwargs.get('job_id') or state == 'IGNORED':
+        return
+    with app.app_context():
+        if state == 'SUCCESS':
+            cache_counts = retval.get('dataset_cache') or {}
+            job = update_job(kwargs['job_id'], Job.DONE, report_id=retval.get('report_id'),
+                             cache_hits=cache_counts.get('hits'),
+                             cache_misses=cache_counts.get('misses'))
+        else:
+            job = update_job(kwargs['job_id'], Job.FAILED, traceback=''.join(
+                traceback.format_exception(type(retval), retval, retval.__traceback__)))
+        # Without chords, batch runs are finished by their last job
+        if job is not None and job.batch_run_id and not chords_supported(worker) \
+                and finish_if_complete(job.batch_run_id):
+            publish_batch_run_finished(BatchRun.get_by_id(job.batch_run_id))
+
+
+@worker.task(ignore_result=app.config['IGNORE_TASK_RESULTS'])
+def finish_batch_run(batch_run_id):
+    """Chord callback, called once every job of a batch run has completed"""
+    batch_run = BatchRun.get_by_id(batch_run_id)
+    batch_run.update(finished_at=datetime.utcnow())
+    publish_batch_run_finished(batch_run)
+
+
+def publish_batch_run_finished(batch_run):
+    progress = batch_run_progress(batch_run)
+    del progress['jobs']
+    publish_event(batch_run.user_id, 'batch_run', progress)
+    logger.info(f"Batch run {batch_run.id} finished")
+
+
+@worker.task(bind=True, ignore_result=app.config['IGNORE_TASK_RESULTS'],
+             max_retries=3, default_retry_delay=30)
+def ingest_staged_files(self, upload_batch_id, user_id, staged_files):
+    """Ingest files previously saved to the staging area by an upload
+
+    Counts are added to the upload batch as each batch of files is committed.
+    Committed files have left the staging area, so a retry resumes from the
+    first uncommitted batch. Files of a batch committed just before a failure
+    are still staged, and are moved into place by the retry as duplicates
+    whose stored file is missing. Files still staged once ingest has definitively
+    failed are counted as failed, and are removed in either case.
+
+    Args:
+        upload_batch_id (str): upload batch the files are counted against
+        user_id (str): uploader ID
+        staged_files (list): (staged path, original filename) pairs
+    """
+    # Files of the batches committed by a previous attempt are gone
+    remaining = [(path, filename) for path, filename in staged_files if os.path.exists(path)]
+    logger.info(f"Ingesting {len(remaining)} of {len(staged_files)} files "
+                f"for upload batch {upload_batch_id}")
+
+    def count_batch(receipts):
+        update_upload_batch(upload_batch_id, **count_receipts(receipts))
+
+    retrying = False
+    try:
+        receipts = ingest_staged(remaining, user_id, on_batch=count_batch)
+    except Exception as e:
+        db.session.rollback()
+        if self.request.retries < self.max_retries:
+            retrying = True
+            raise self.retry(exc=e)
+        left = [path for path, _ in remaining if os.path.exists(path)]
+        update_upload_batch(upload_batch_id, failed=len(left))
+        raise
+    finally:
+        if not retrying:
+            remove_staged(remaining)
+
+    counts = count_receipts(receipts)
+    logger.info(f"Upload batch {upload_batch_id}: {counts}")
+    return counts
+
+
+@worker.task(bind=True, ignore_result=app.config['IGNORE_TASK_RESULTS'])
+def import_archive_upload(self, upload_batch_id, user_id, archive_path):
+    """Import a staged ZIP/TAR archive, counting its files per batch
+
+    Args:
+        upload_batch_id (str): upload batch the files are counted against
+        user_id (str): uploader ID
+        archive_path (str): staged archive, removed once imported
+    """
+    logger.info(f"Importing archive for upload batch {upload_batch_id}")
+
+    def count_batch(receipts):
+        update_upload_batch(upload_batch_id, staged=len(receipts),
+                            **count_receipts(receipts))
+
+    try:
+        counts = import_archive(archive_path, user_id, on_batch=count_batch)
+    finally:
+        os.remove(archive_path)
+
+    logger.info(f"Upload batch {upload_batch_id}: {counts}")
+    return counts
+
+
+@worker.task(ignore_result=app.config['IGNORE_TASK_RESULTS'])
+def expire_uploads():
+    """Periodically remove abandoned chunked uploads, see CELERYBEAT_SCHEDULE"""
+    return expire_partial_uploads()
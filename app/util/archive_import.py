@@ -0,0 +1,162 @@
+"""Import of whole QA sessions exported as ZIP/TAR archives or DICOMDIR media.
+
+Archive members are streamed one at a time into the staging area and
+ingested in batches through the usual ingest pipeline, so the archive is
+never extracted to disk as a whole and memory use does not grow with its
+size. Members that are not DICOM are skipped.
+"""
+import os
+import posixpath
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+import pydicom
+from flask import current_app
+from werkzeug.utils import secure_filename
+
+from app.util.im2db_utils import ingest_staged, peek_image_uid, count_receipts, \
+    update_upload_batch, PEEK_BYTES
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+
+class ArchiveError(Exception): pass
+
+
+def is_archive(filename):
+    """Whether an uploaded file should be imported as an archive"""
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def is_dicom(prefix):
+    """Whether the first bytes of a file look like DICOM
+
+    Files written without the 128 byte preamble and "DICM" prefix are
+    recognised by parsing their SOP Instance UID.
+    """
+    return prefix[128:132] == b'DICM' or peek_image_uid(prefix) is not None
+
+
+def iter_archive_members(archive_path):
+    """Stream the members of a ZIP or TAR archive
+
+    ZIP archives with a DICOMDIR only yield the files it references.
+
+    Yields:
+        tuple: (member name, readable file object)
+    """
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            names = [info.filename for info in archive.infolist() if not info.is_dir()]
+            referenced = _dicomdir_references(archive, names)
+            for name in referenced or names:
+                with archive.open(name) as member:
+                    yield name, member
+    elif tarfile.is_tarfile(archive_path):
+        # Stream mode reads members sequentially without seeking, so a
+        # DICOMDIR cannot be followed and members are sniffed instead
+        with tarfile.open(archive_path, 'r|*') as archive:
+            for info in archive:
+                if info.isfile():
+                    yield info.name, archive.extractfile(info)
+    else:
+        raise ArchiveError(f"{os.path.basename(archive_path)} is not a ZIP or TAR archive")
+
+
+def _dicomdir_references(archive, names):
+    # Files referenced by a DICOMDIR in the archive, as member names
+    by_lower_name = {name.lower(): name for name in names}
+    dicomdirs = [name for name in names if posixpath.basename(name).upper() == 'DICOMDIR']
+    referenced = []
+    for dicomdir_name in dicomdirs:
+        with archive.open(dicomdir_name) as member:
+            dicomdir = pydicom.dcmread(member, force=True)
+        root = posixpath.dirname(dicomdir_name)
+        for record in dicomdir.get('DirectoryRecordSequence', []):
+            file_id = record.get('ReferencedFileID')
+            if not file_id:
+                continue
+            parts = [file_id] if isinstance(file_id, str) else list(file_id)
+            name = by_lower_name.get(posixpath.join(root, *parts).lower())
+            if name is not None:
+                referenced.append(name)
+    return referenced
+
+
+def import_archive(archive_path, user_id, on_batch=None):
+    """Ingest every DICOM file in an archive, batch by batch
+
+    Args:
+        archive_path (str): path to a ZIP or TAR archive
+        user_id: uploader ID
+        on_batch (callable, optional): called with the receipts of each
+            ingested batch. Defaults to None.
+
+    Returns:
+        dict: counts of files parsed, duplicate, failed and skipped
+    """
+    max_files = current_app.config['INGEST_BATCH_FILES']
+    max_bytes = current_app.config['INGEST_BATCH_BYTES']
+    counts = {'parsed': 0, 'duplicate': 0, 'failed': 0, 'skipped': 0}
+    batch, batch_bytes = [], 0
+
+    def flush():
+        receipts = ingest_staged(batch, user_id)
+        for key, count in count_receipts(receipts).items():
+            counts[key] += count
+        if on_batch is not None:
+            on_batch(receipts)
+
+    try:
+        for name, member in iter_archive_members(archive_path):
+            if posixpath.basename(name).upper() == 'DICOMDIR':
+                continue
+            staged_path, size = _stage_member(member)
+            if staged_path is None:
+                counts['skipped'] += 1
+                continue
+            batch.append((staged_path, secure_filename(posixpath.basename(name))))
+            batch_bytes += size
+            if len(batch) >= max_files or batch_bytes >= max_bytes:
+                flush()
+                batch, batch_bytes = [], 0
+        if batch:
+            flush()
+    finally:
+        # Remove members staged for a batch that was never ingested
+        for staged_path, _ in batch:
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
+
+    current_app.logger.info(
+        f"Imported {os.path.basename(archive_path)}: {counts}")
+    return counts
+
+
+def queue_archive(archive_path, upload_batch_id, user_id):
+    """Queue a staged archive for import by the Celery worker
+
+    Its files are counted against the upload batch as they are found.
+    """
+    from app.tasks import import_archive_upload
+
+    update_upload_batch(upload_batch_id, user_id=user_id)
+    import_archive_upload.delay(upload_batch_id=upload_batch_id.hex,
+                                user_id=str(user_id), archive_path=archive_path)
+    return upload_batch_id
+
+
+def _stage_member(member):
+    # Stream an archive member into the staging area if it is DICOM
+    prefix = member.read(PEEK_BYTES)
+    if not is_dicom(prefix):
+        return None, 0
+    fd, staged_path = tempfile.mkstemp(dir=current_app.config['STAGING_PATH'],
+                                       prefix='upload-')
+    with os.fdopen(fd, 'wb') as staged:
+        staged.write(prefix)
+        shutil.copyfileobj(member, staged, 1024 * 1024)
+        size = staged.tell()
+    return staged_path, size
@@ -0,0 +1,258 @@
+"""Batch runs: the jobs of one task over many series, tracked as a unit.
+
+The jobs of a batch run are submitted as a Celery chord, a group of
+``produce_report`` tasks whose completion callback marks the run finished.
+Result backends without chord support, such as the ``rpc://`` backend of local
+installs, get a plain group instead, and the last job to finish marks the run
+finished, see ``finish_if_complete``.
+Each job has its own Job row, updated by the worker as it starts and ends, from
+which the progress of the run is aggregated.
+
+A protocol run has several tasks instead of one, and each of its jobs runs all
+of them over its series with ``produce_protocol_reports``. A sweep run has a
+grid of parameter sets, and each of its jobs evaluates the task with all of
+them with ``produce_sweep_reports``.
+"""
+import hashlib
+import uuid
+from datetime import datetime
+
+from celery import chord, group
+from flask import current_app
+from sqlalchemy import func
+
+from app import db
+from app.models import BatchRun, Job, Task
+from app.util.im2db_utils import manifest_version
+from app.util.events import publish_event
+
+# Task name of the jobs of protocol runs
+PROTOCOL = 'protocol'
+
+
+def create_batch_run(user_id, task_name, job_series, parameters=None, force=False,
+                     task_names=None, parameter_grid=None):
+    """Create a batch run and queue its jobs
+
+    Args:
+        user_id: ID of the user submitting the run
+        task_name (str): hazenlib task, or PROTOCOL
+        job_series (list): per job, the series its report is attached to
+            and the list of series whose images it processes
+        parameters (dict, optional): task arguments. Defaults to None.
+        force (bool, optional): recompute cached reports. Defaults to False.
+        task_names (list, optional): hazenlib tasks of a protocol run.
+            Defaults to None.
+        parameter_grid (list, optional): task arguments of a sweep run.
+            Defaults to None.
+
+    Returns:
+        BatchRun: the queued batch run
+    """
+    batch_run = BatchRun(user_id=user_id, parameters=parameters or {}, force=force,
+                         task_name=None if task_name == PROTOCOL else task_name,
+                         task_names=task_names, parameter_grid=parameter_grid)
+    jobs = [Job(batch_run=batch_run, task_name=task_name, series_id=series_id,
+                series_ids=[str(input_id) for input_id in series_ids])
+            for series_id, series_ids in job_series]
+    db.session.add(batch_run)
+    db.session.add_all(jobs)
+    db.session.commit()
+    submit_jobs(batch_run, jobs)
+    return batch_run
+
+
+def submit_jobs(batch_run, jobs):
+    """Queue jobs of a batch run as a Celery chord, or a group without chord support"""
+    from app.tasks import produce_report, produce_protocol_reports, produce_sweep_reports, \
+        finish_batch_run
+
+    for job in jobs:
+        job.update(commit=False, status=Job.QUEUED, celery_id=str(uuid.uuid4()),
+                   enqueued_at=datetime.utcnow(), started_at=None, finished_at=None,
+                   worker=None, runtime=None, traceback=None, report_id=None,
+                   cache_hits=None, cache_misses=None)
+    batch_run.update(commit=False, finished_at=None)
+    # Committed before queueing, so that workers find the jobs
+    db.session.commit()
+
+    if not jobs:
+        batch_run.update(finished_at=datetime.utcnow())
+        return None
+    if batch_run.task_names:
+        options = combined_routing_options(batch_run.task_names)
+        signature, task_args = produce_protocol_reports.s, {'task_names': batch_run.task_names}
+    elif batch_run.parameter_grid:
+        options = combined_routing_options([batch_run.task_name] * len(batch_run.parameter_grid))
+        signature, task_args = produce_sweep_reports.s, {
+            'task_name': batch_run.task_name, 'parameter_grid': batch_run.parameter_grid}
+    else:
+        options = routing_options(batch_run.task_name)
+        signature, task_args = produce_report.s, {'task_name': batch_run.task_name}
+    header = [signature(
+        user_id=str(batch_run.user_id), series_id=str(job.series_id),
+        series_ids=job.series_ids, manifest_version=manifest_version(job.series_ids),
+        force=batch_run.force, job_id=str(job.id), **task_args, **batch_run.parameters
+    ).set(task_id=job.celery_id, **options) for job in jobs]
+    if not chords_supported(finish_batch_run.app):
+        # Finished by the last job, see job_finished
+        return group(header).apply_async()
+    # Also called if a job fails, once the others have completed
+    callback = finish_batch_run.si(str(batch_run.id))
+    return chord(header)(callback.on_error(finish_batch_run.si(str(batch_run.id))))
+
+
+def chords_supported(celery_app):
+    """Whether the result backend of a Celery app can run chords, rpc:// cannot"""
+    try:
+        celery_app.backend.ensure_chords_allowed()
+    except NotImplementedError:
+        return False
+    return True
+
+
+def finish_if_complete(batch_run_id):
+    """Mark a batch run finished once none of its jobs are queued or running
+
+    Takes the place of the chord callback without chord support. The run is
+    only updated while not finished, so of several jobs finishing at once,
+    exactly one finishes the run.
+
+    Returns:
+        bool: whether this call finished the run
+    """
+    pending = db.session.query(Job.id).filter(
+        Job.batch_run_id == BatchRun.id,
+        Job.status.in_((Job.QUEUED, Job.RUNNING))).exists()
+    finished = BatchRun.query.filter(
+        BatchRun.id == batch_run_id, BatchRun.finished_at.is_(None), ~pending
+    ).update({BatchRun.finished_at: datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
+    return finished == 1
+
+
+def routing_options(task_name):
+    """Celery queue and time limits of a hazenlib task, from its cost class"""
+    task = Task.query.filter_by(name=task_name).first()
+    cost_class = (task and task.cost_class) or current_app.config['TASK_COST_CLASS_DEFAULT']
+    cost = current_app.config['TASK_COST_CLASSES'][cost_class]
+    return {'queue': (task and task.queue) or cost['queue'],
+            'soft_time_limit': cost['soft_time_limit'],
+            'time_limit': cost['time_limit']}
+
+
+def combined_routing_options(task_names):
+    """Queue of the costliest of several task runs made by one job, with their total time limits"""
+    options = [routing_options(task_name) for task_name in task_names]
+    costliest = max(options, key=lambda task_options: task_options['time_limit'])
+    return {'queue': costliest['queue'],
+            'soft_time_limit': sum(task_options['soft_time_limit'] for task_options in options),
+            'time_limit': sum(task_options['time_limit'] for task_options in options)}
+
+
+def retry_batch_run(batch_run):
+    """Queue the failed jobs of a batch run again
+
+    Returns:
+        int: number of jobs queued
+    """
+    failed = batch_run.jobs.filter_by(status=Job.FAILED).all()
+    if failed:
+        submit_jobs(batch_run, failed)
+    return len(failed)
+
+
+def update_job(job_id, status, **fields):
+    """Record a job starting or ending, from the worker
+
+    Args:
+        job_id (str): Job ID
+        status (str): Job.RUNNING, Job.DONE or Job.FAILED
+        **fields: other Job columns, such as worker, report_id or traceback
+    """
+    job = Job.get_by_id(job_id)
+    if job is None:
+        return None
+    now = datetime.utcnow()
+    if status == Job.RUNNING:
+        job.update(status=status, started_at=now, **fields)
+    else:
+        runtime = (now - job.started_at).total_seconds() if job.started_at else None
+        job.update(status=status, finished_at=now, runtime=runtime, **fields)
+    publish_event(job.batch_run.user_id, 'job', job_json(job))
+    return job
+
+
+def job_json(job):
+    """Job status as a JSON-serialisable dict"""
+    queue_latency = None
+    if job.enqueued_at and job.started_at:
+        queue_latency = (job.started_at - job.enqueued_at).total_seconds()
+    return {
+        'job_id': job.id.hex,
+        'batch_run_id': job.batch_run_id.hex if job.batch_run_id else None,
+        'task_name': job.task_name,
+        'series_id': str(job.series_id),
+        'status': job.status,
+        'worker': job.worker,
+        'enqueued_at': job.enqueued_at.isoformat() if job.enqueued_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'queue_latency': queue_latency,  # seconds
+        'runtime': job.runtime,  # seconds
+        'report_id': str(job.report_id) if job.report_id else None,
+        'traceback': job.traceback,
+        'cache_hits': job.cache_hits,
+        'cache_misses': job.cache_misses,
+    }
+
+
+def jobs_etag(query):
+    """ETag of the state of some jobs, without loading them
+
+    Every change of status sets one of the job timestamps, so the count of
+    jobs and their latest timestamp identify the state of the whole set.
+    """
+    count, latest = query.with_entities(
+        func.count(Job.id),
+        func.max(func.greatest(Job.enqueued_at, Job.started_at, Job.finished_at)),
+    ).order_by(None).one()
+    return hashlib.sha1(f'{count}:{latest}'.encode()).hexdigest()
+
+
+def batch_run_progress(batch_run):
+    """Aggregate progress of a batch run
+
+    Throughput is the number of jobs finished per minute since the first job
+    started, and the ETA extrapolates it over the remaining jobs.
+
+    Returns:
+        dict: counts of jobs by status, throughput, ETA and per-job status
+    """
+    counts = dict.fromkeys((Job.QUEUED, Job.RUNNING, Job.DONE, Job.FAILED), 0)
+    counts.update(db.session.query(Job.status, func.count(Job.id)).filter(
+        Job.batch_run_id == batch_run.id).group_by(Job.status))
+    total = sum(counts.values())
+    finished = counts[Job.DONE] + counts[Job.FAILED]
+
+    first_started = db.session.query(func.min(Job.started_at)).filter(
+        Job.batch_run_id == batch_run.id).scalar()
+    throughput, eta = None, None
+    if first_started is not None and finished:
+        elapsed = ((batch_run.finished_at or datetime.utcnow()) - first_started).total_seconds()
+        throughput = 60 * finished / max(elapsed, 1)
+        eta = 60 * (total - finished) / throughput
+
+    return {
+        'batch_run_id': batch_run.id.hex,
+        'task_name': batch_run.task_name or PROTOCOL,
+        'task_names': batch_run.task_names or [batch_run.task_name],
+        'total': total,
+        **counts,
+        'throughput': throughput,  # jobs per minute
+        'eta': eta,  # seconds
+        'complete': batch_run.finished_at is not None,
+        'jobs': [{'job_id': job.id.hex, 'series_id': str(job.series_id),
+                  'status': job.status}
+                 for job in batch_run.jobs.order_by(Job.created_at)],
+    }
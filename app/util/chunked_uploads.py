@@ -0,0 +1,207 @@
+"""Chunked, resumable uploads of large DICOM files and archives.
+
+Chunks follow the Dropzone chunking protocol (``dzuuid``, ``dzchunkindex``,
+``dztotalchunkcount``, ``dzchunksize``, ``dztotalfilesize`` and
+``dzchunkbyteoffset`` form fields) and may arrive in parallel and in any
+order. Each chunk carries the SHA-256 of its content in a ``chunk_checksum``
+field, computed by the browser, and is only kept as its own part file once
+verified. When every part is present, the parts are assembled into a single
+staged file that is ingested like any other upload.
+"""
+import os
+import shutil
+import time
+import uuid
+
+from flask import current_app
+
+from app.util.im2db_utils import StagedFile, ImageExistsError
+from app.util.result_cache import file_checksum
+
+
+class ChunkError(Exception): pass
+
+
+def chunk_directory(upload_id):
+    """Folder holding the parts of a chunked upload
+
+    Args:
+        upload_id (str): client-generated upload UUID (``dzuuid``)
+
+    Raises:
+        ChunkError: if upload_id is not a UUID
+    """
+    try:
+        upload_id = uuid.UUID(upload_id).hex
+    except (TypeError, ValueError):
+        raise ChunkError(f"Invalid upload ID: {upload_id}")
+    return os.path.join(current_app.config['STAGING_PATH'], 'chunks', upload_id)
+
+
+def received_chunks(upload_id):
+    """Progress of a chunked upload, so that a client can resume it
+
+    Returns:
+        dict: received chunk indexes and the byte offset up to which the
+            upload is contiguous
+    """
+    directory = chunk_directory(upload_id)
+    sizes = {}
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.endswith('.part'):
+                sizes[int(name[:-5])] = os.path.getsize(os.path.join(directory, name))
+    offset, index = 0, 0
+    while index in sizes:
+        offset += sizes[index]
+        index += 1
+    return {'upload_id': upload_id, 'received': sorted(sizes), 'offset': offset}
+
+
+def save_chunk(file, form):
+    """Store one chunk of an upload, assembling the file once all are present
+
+    Args:
+        file: werkzeug FileStorage holding the chunk
+        form: request form with the Dropzone chunk fields and the
+            ``chunk_checksum`` SHA-256 hex digest of the chunk
+
+    Returns:
+        str: path of the assembled file, or None if the upload is not yet
+            complete or another request is assembling it
+
+    Raises:
+        ChunkError: if the chunk is inconsistent with the upload
+        ImageExistsError: if the first chunk shows the image is already stored
+    """
+    directory = chunk_directory(form.get('dzuuid'))
+    duplicate_marker = os.path.join(directory, 'duplicate')
+    try:
+        index = int(form['dzchunkindex'])
+        total_chunks = int(form['dztotalchunkcount'])
+        chunk_size = int(form['dzchunksize'])
+        total_size = int(form['dztotalfilesize'])
+        offset = int(form.get('dzchunkbyteoffset', index * chunk_size))
+    except (KeyError, ValueError):
+        raise ChunkError("Missing or invalid chunk fields")
+    if not form.get('chunk_checksum'):
+        raise ChunkError(f"Chunk {index} has no checksum")
+    if not 0 <= index < total_chunks or offset != index * chunk_size:
+        raise ChunkError(f"Chunk {index} does not fit the upload")
+    if total_size > current_app.config['DROPZONE_MAX_FILE_SIZE'] * 1024 ** 2:
+        raise ChunkError("File is too large")
+
+    os.makedirs(directory, exist_ok=True)
+    # The first chunk is peeked for the image UID as it is received, there is
+    # no point storing the rest of an image that is already in the database
+    if os.path.exists(duplicate_marker):
+        raise ImageExistsError(f"Upload {form['dzuuid']}")
+    if isinstance(file.stream, StagedFile) and file.stream.duplicate:
+        open(duplicate_marker, 'w').close()
+        raise ImageExistsError(f"UID: {file.stream.image_uid}")
+
+    # Written under a temporary name, so only complete chunks are visible
+    part_path = os.path.join(directory, f'{index:06d}.part')
+    temp_path = f'{part_path}.{uuid.uuid4().hex}'
+    if isinstance(file.stream, StagedFile):
+        file.stream.flush()
+        os.replace(file.stream.name, temp_path)
+    else:
+        file.save(temp_path)
+
+    size, expected_size = os.path.getsize(temp_path), min(chunk_size, total_size - offset)
+    if size != expected_size:
+        os.remove(temp_path)
+        raise ChunkError(f"Chunk {index} is {size} bytes, expected {expected_size}")
+    if file_checksum(temp_path) != form['chunk_checksum'].lower():
+        os.remove(temp_path)
+        raise ChunkError(f"Checksum mismatch for chunk {index}")
+    os.replace(temp_path, part_path)
+
+    if len(received_chunks(form['dzuuid'])['received']) < total_chunks:
+        return None
+    return assemble_chunks(directory, total_chunks, total_size)
+
+
+def assemble_chunks(directory, total_chunks, total_size):
+    """Concatenate the parts of a complete upload into one staged file
+
+    Only the first request to find the upload complete assembles it. Each
+    part was verified against its checksum as it was received.
+
+    Returns:
+        str: path of the assembled file, or None if another request
+            is assembling it
+
+    Raises:
+        ChunkError: if the assembled file does not match the upload size
+    """
+    try:
+        os.close(os.open(os.path.join(directory, 'assembling'),
+                         os.O_CREAT | os.O_EXCL))
+    except FileExistsError:
+        return None
+
+    assembled_path = os.path.join(current_app.config['STAGING_PATH'],
+                                  f'chunked-{uuid.uuid4().hex}')
+    try:
+        with open(assembled_path, 'wb') as assembled:
+            for index in range(total_chunks):
+                with open(os.path.join(directory, f'{index:06d}.part'), 'rb') as part:
+                    shutil.copyfileobj(part, assembled, 1024 * 1024)
+        if os.path.getsize(assembled_path) != total_size:
+            raise ChunkError("Assembled file does not match the upload size")
+    except Exception:
+        if os.path.exists(assembled_path):
+            os.remove(assembled_path)
+        raise
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return assembled_path
+
+
+def expire_partial_uploads(max_age=None):
+    """Remove abandoned chunked uploads, upload batch folders and stale spool files
+
+    Args:
+        max_age (int, optional): seconds since last written.
+            Defaults to CHUNK_UPLOAD_EXPIRY.
+
+    Returns:
+        int: number of uploads removed
+    """
+    if max_age is None:
+        max_age = current_app.config['CHUNK_UPLOAD_EXPIRY']
+    cutoff = time.time() - max_age
+    removed = 0
+
+    chunks_root = os.path.join(current_app.config['STAGING_PATH'], 'chunks')
+    if os.path.isdir(chunks_root):
+        for name in os.listdir(chunks_root):
+            directory = os.path.join(chunks_root, name)
+            mtimes = [os.path.getmtime(os.path.join(directory, part))
+                      for part in os.listdir(directory)] or [os.path.getmtime(directory)]
+            if max(mtimes) < cutoff:
+                shutil.rmtree(directory, ignore_errors=True)
+                removed += 1
+
+    # Spool and assembled files of requests that never completed, and upload
+    # batch folders whose files were never ingested
+    staging = current_app.config['STAGING_PATH']
+    for name in os.listdir(staging):
+        path = os.path.join(staging, name)
+        if name.startswith(('upload-', 'chunked-')) and os.path.getmtime(path) < cutoff:
+            os.remove(path)
+            removed += 1
+        elif name != 'chunks' and os.path.isdir(path) and _last_modified(path) < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+
+    current_app.logger.info(f"Expired {removed} partial uploads")
+    return removed
+
+
+def _last_modified(directory):
+    # Latest modification time of a folder or the files it holds
+    return max([os.path.getmtime(directory)] + [
+        os.path.getmtime(os.path.join(directory, name)) for name in os.listdir(directory)])
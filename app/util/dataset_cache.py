@@ -0,0 +1,200 @@
+"""Worker-side cache of decoded DICOM datasets, shared by the tasks of a worker.
+
+hazenlib tasks read every file of a series with ``dcmread`` each time they
+access their data, and every task run on a series reads it again. Within a
+worker process, datasets are instead read and their pixels decoded once, then
+kept in a byte-bounded LRU keyed by file path, modification time and size, so
+that a file replaced on disk is read again.
+
+Each read returns a copy of the cached dataset, with its PixelData and its own
+writable pixel array, so changes made by one task are not seen by another.
+Optionally, decoded pixels are also written to a pixel store directory (ideally
+on tmpfs, such as /dev/shm) and memory-mapped copy-on-write, so that the
+prefork children of a worker share a single copy of them in the page cache.
+"""
+import copy
+import hashlib
+import importlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from pydicom import dcmread
+from pydicom.dataset import FileDataset, get_image_pixel_ids
+
+# Allowance for the header of each cached dataset
+HEADER_BYTES = 16 * 1024
+
+
+class PixelStore:
+    """Decoded pixel arrays as .npy files, memory-mapped copy-on-write
+
+    Args:
+        directory (str): folder shared by the worker processes
+        max_bytes (int): size above which the least recently written
+            arrays are removed
+    """
+
+    PRUNE_EVERY = 64
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest() + '.npy')
+
+    def get(self, key):
+        # Each mapping is private, writes to it are never seen by other readers
+        try:
+            return np.load(self._path(key), mmap_mode='c')
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, key, array):
+        # Written under a temporary name, other processes may be reading
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            np.save(file, array)
+        os.replace(temp_path, self._path(key))
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self.prune()
+        return self.get(key)
+
+    def prune(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npy'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class DatasetCache:
+    """Byte-bounded LRU of decoded datasets
+
+    Args:
+        max_bytes (int): bound on the cached pixel and header bytes
+        pixel_store (PixelStore, optional): store shared between processes.
+            Defaults to None.
+    """
+
+    def __init__(self, max_bytes, pixel_store=None):
+        self.max_bytes = max_bytes
+        self.pixel_store = pixel_store
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, file_path, **kwargs):
+        """Drop-in for ``dcmread`` on a file path, returning a private copy"""
+        if kwargs:
+            return dcmread(file_path, **kwargs)
+        stat = os.stat(file_path)
+        key = (os.path.realpath(file_path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry is None:
+            entry = self._load(file_path, key)
+            self._add(key, entry)
+        dataset, pixels, _ = entry
+        return _copy_dataset(dataset, self._private_pixels(key, pixels))
+
+    def counts(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _load(self, file_path, key):
+        dataset = dcmread(file_path)
+        if 'PixelData' not in dataset:
+            return dataset, None, HEADER_BYTES
+        size = HEADER_BYTES + len(dataset.PixelData)
+        if self.pixel_store:
+            pixels = self.pixel_store.get(key)
+            if pixels is None:
+                pixels = self.pixel_store.put(key, dataset.pixel_array)
+            return dataset, pixels, size
+        pixels = dataset.pixel_array
+        pixels.flags.writeable = False
+        return dataset, pixels, size + pixels.nbytes
+
+    def _private_pixels(self, key, pixels):
+        # A fresh copy-on-write mapping from the store, otherwise a copy,
+        # which is still much cheaper than decoding the pixels again
+        if pixels is None:
+            return None
+        if self.pixel_store:
+            mapped = self.pixel_store.get(key)
+            if mapped is not None:
+                return mapped
+        return pixels.copy()
+
+    def _add(self, key, entry):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = entry
+            self.size += entry[2]
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted[2]
+
+
+def _copy_dataset(dataset, pixels):
+    # Elements are copied, their values are shared
+    clone = FileDataset(
+        dataset.filename, {element.tag: copy.copy(element) for element in dataset},
+        preamble=dataset.preamble, file_meta=dataset.file_meta,
+        is_implicit_VR=dataset.is_implicit_VR, is_little_endian=dataset.is_little_endian)
+    if pixels is not None:
+        clone._pixel_array = pixels
+        clone._pixel_id = get_image_pixel_ids(clone)
+    return clone
+
+
+_cache = None
+
+
+def install_dataset_cache(config):
+    """Make hazenlib tasks read their data through the process' dataset cache
+
+    Returns:
+        DatasetCache: the cache, or None if DATASET_CACHE_BYTES is 0
+    """
+    global _cache
+    if not config['DATASET_CACHE_BYTES']:
+        return None
+    pixel_store = None
+    if config['DATASET_CACHE_PIXEL_STORE']:
+        pixel_store = PixelStore(config['DATASET_CACHE_PIXEL_STORE'],
+                                 config['DATASET_CACHE_PIXEL_STORE_BYTES'])
+    _cache = DatasetCache(config['DATASET_CACHE_BYTES'], pixel_store)
+
+    # hazenlib.HazenTask is also the name of the class, the module is imported by path
+    hazen_task_module = importlib.import_module('hazenlib.HazenTask')
+    hazen_task_module.dcmread = _cache.read
+    return _cache
+
+
+def dataset_cache():
+    """The process' dataset cache, or None if not installed"""
+    return _cache
@@ -0,0 +1,64 @@
+"""Job progress pushed to the browser as Server-Sent Events.
+
+The worker publishes job state changes and new reports on a per-user Redis
+pub/sub channel, and the ``main.events`` stream relays them to the open
+workbench and series pages. Redis is taken from the Celery broker when it is
+a Redis broker, or from EVENTS_REDIS_URL. Without it nothing is published and
+pages fall back to polling the ``main.jobs`` list, see static/js/job_events.js.
+"""
+import json
+
+import redis
+from flask import current_app
+
+_clients = {}
+
+
+def events_enabled():
+    return bool(current_app.config.get('EVENTS_REDIS_URL'))
+
+
+def user_channel(user_id):
+    return f'hazen:events:{user_id}'
+
+
+def _client():
+    url = current_app.config['EVENTS_REDIS_URL']
+    if url not in _clients:
+        _clients[url] = redis.Redis.from_url(url)
+    return _clients[url]
+
+
+def publish_event(user_id, event, data):
+    """Publish an event to the pages a user has open
+
+    Failures are only logged, so that a Redis outage never fails a job.
+    """
+    if not events_enabled() or user_id is None:
+        return
+    try:
+        _client().publish(user_channel(user_id), json.dumps({'event': event, 'data': data}))
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Could not publish {event} event: {e}")
+
+
+def event_stream(user_id, heartbeat=15):
+    """Server-Sent Events relaying the events published for a user
+
+    A comment is sent every heartbeat seconds without events, which keeps
+    proxies from timing out and ends the stream once the client has gone.
+    """
+    pubsub = _client().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(user_channel(user_id))
+    try:
+        # Reconnect after 5 seconds if the connection is lost
+        yield 'retry: 5000\n\n'
+        while True:
+            message = pubsub.get_message(timeout=heartbeat)
+            if message is None:
+                yield ': keep-alive\n\n'
+                continue
+            payload = json.loads(message['data'])
+            yield f"event: {payload['event']}\ndata: {json.dumps(payload['data'])}\n\n"
+    finally:
+        pubsub.close()
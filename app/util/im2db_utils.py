@@ -1,152 +1,780 @@
 import os
 import shutil
+import uuid
+import hashlib
+import tempfile
+import multiprocessing
 import pydicom
+from pydicom.datadict import tag_for_keyword
+from pydicom.filereader import read_partial
+from pydicom.multival import MultiValue
+from pydicom.valuerep import DSfloat, DSdecimal, IS
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from io import BytesIO
+
+from sqlalchemy.dialects.postgresql import insert
 
 from app import db
-from app.models import Image, Series, Study, Device
+from app.models import Image, Series, Study, Device, UploadBatch
 from flask_login import current_user
-from flask import current_app, flash, url_for, redirect
-from werkzeug.utils import secure_filename
+from flask import current_app, flash, url_for, redirect, Request, has_request_context
+from werkzeug.utils import secure_filename, cached_property
 
 
 class ImageExistsError(Exception): pass
 
 
+class ManifestError(Exception): pass
+
+
 def upload_file(file):
-    filename = secure_filename(file.filename)
-    secure_path = os.path.join(current_app.config['UPLOADED_PATH'], filename)
-    try:
-        file.save(secure_path)
-    except IsADirectoryError:
+    upload_files([file])
+
+
+def upload_files(files):
+    """Save uploaded files and ingest them as a single batch
+
+    Args:
+        files (list): werkzeug FileStorage objects from the request
+    """
+    from app.util.archive_import import is_archive, import_archive, queue_archive
+
+    files = [file for file in files if file.filename]
+    if not files:
         flash("No files were selected", 'info')
         return redirect(url_for('main.workbench'))
 
+    # Archives are imported member by member
+    archives = [file for file in files if is_archive(file.filename)]
+    files = [file for file in files if not is_archive(file.filename)]
+    for archive in archives:
+        archive_path = save_upload(archive)
+        if current_app.config['INGEST_ASYNC']:
+            upload_batch_id = queue_archive(archive_path, uuid.uuid4(), current_user.id)
+            flash(f"{archive.filename} has been queued for import "
+                  f"(batch {upload_batch_id})", 'info')
+            continue
+        try:
+            counts = import_archive(archive_path, current_user.id)
+            flash(f"{archive.filename}: {counts['parsed']} files imported, "
+                  f"{counts['duplicate']} already uploaded, "
+                  f"{counts['failed'] + counts['skipped']} skipped", 'success')
+        except Exception as e:
+            flash(f"{archive.filename} could not be imported: {e}", 'danger')
+        finally:
+            os.remove(archive_path)
+    if not files:
+        return
+
+    if current_app.config['INGEST_ASYNC']:
+        upload_batch_id = stage_uploads(files, uuid.uuid4(), current_user.id)
+        flash(f"{len(files)} files have been queued for upload "
+              f"(batch {upload_batch_id})", 'info')
+        return
+
+    for receipt in receive_uploads(files, current_user.id):
+        if receipt['duplicate']:
+            flash(f"{receipt['filename']} file has already been uploaded!", 'danger')
+        elif receipt['error']:
+            flash(f"{receipt['filename']} could not be read as DICOM!", 'danger')
+        else:
+            flash(f"{receipt['filename']} file has been uploaded successfully!", 'success')
+
+
+def receive_uploads(files, user_id):
+    """Ingest uploaded files straight from where they were spooled
+
+    Files already recognised as duplicates while they were being received
+    are skipped, the rest are ingested as a batch and renamed into their
+    series folder. Duplicates and unreadable files are removed.
+
+    Args:
+        files (list): werkzeug FileStorage objects from the request
+        user_id: uploader ID
+
+    Returns:
+        list: one receipt dict per file, in the same order
+    """
+    receipts, staged = [], []
+    for file in files:
+        filename = secure_filename(file.filename)
+        if isinstance(file.stream, StagedFile) and file.stream.duplicate:
+            receipt = _new_receipt(file.stream.name, filename)
+            receipt.update(image_uid=file.stream.image_uid, duplicate=True)
+            receipts.append(receipt)
+        else:
+            staged.append((save_upload(file), filename))
+            receipts.append(None)
+
+    ingested = iter(ingest_staged(staged, user_id))
+    receipts = [receipt or next(ingested) for receipt in receipts]
+    for receipt in receipts:
+        if receipt['duplicate'] and os.path.exists(receipt['path']):
+            os.remove(receipt['path'])
+    return receipts
+
+
+def ingest_staged(staged, user_id, workers=None, on_batch=None):
+    """Ingest staged files, removing those that are duplicates or unreadable
+
+    Files leave the staging area as soon as their batch is committed, so
+    after a failure the files still staged are those left to ingest.
+
+    Args:
+        staged (list): (staged path, filename) pairs
+        user_id: uploader ID
+        workers (int, optional): number of header parsing workers.
+            Defaults to INGEST_WORKERS.
+        on_batch (callable, optional): called with the receipts of each
+            batch once it is stored. Defaults to None.
+
+    Returns:
+        list: one receipt dict per staged file, in the same order
+    """
+    def remove_rejected(batch_receipts):
+        for receipt in batch_receipts:
+            if (receipt['duplicate'] or receipt['error']) and os.path.exists(receipt['path']):
+                os.remove(receipt['path'])
+        if on_batch is not None:
+            on_batch(batch_receipts)
+
+    return ingest_images([path for path, _ in staged], user_id=user_id,
+                         filenames=[filename for _, filename in staged],
+                         workers=workers, on_batch=remove_rejected)
+
+
+def remove_staged(staged):
+    """Remove staged files left behind, and their upload batch folder once empty"""
+    directories = set()
+    for path, _ in staged:
+        if os.path.exists(path):
+            os.remove(path)
+        directories.add(os.path.dirname(path))
+    staging_path = os.path.abspath(current_app.config['STAGING_PATH'])
+    for directory in directories:
+        if os.path.abspath(directory) != staging_path:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass
+
+
+def save_upload(file, directory=None):
+    """Place an uploaded file at a unique path in the staging area
+
+    Files spooled by StagingRequest are already on the staging filesystem
+    and are only renamed, anything else is copied.
+
+    Args:
+        file: werkzeug FileStorage object from the request
+        directory (str, optional): Defaults to STAGING_PATH.
+
+    Returns:
+        str: path of the staged file
+    """
+    directory = directory or current_app.config['STAGING_PATH']
+    staged_path = os.path.join(directory, uuid.uuid4().hex)
+    if isinstance(file.stream, StagedFile):
+        file.stream.flush()
+        os.replace(file.stream.name, staged_path)
+    else:
+        file.save(staged_path)
+    return staged_path
+
+
+def stage_uploads(files, upload_batch_id, user_id):
+    """Save uploaded files to the staging area and queue them for ingest
+
+    The request only writes the files to disk, header parsing and database
+    writes happen in the Celery worker.
+
+    Args:
+        files (list): werkzeug FileStorage objects from the request
+        upload_batch_id (uuid.UUID): batch to count these files against
+        user_id: uploader ID
+
+    Returns:
+        uuid.UUID: the upload batch ID
+    """
+    directory = os.path.join(current_app.config['STAGING_PATH'],
+                             upload_batch_id.hex)
+    os.makedirs(directory, exist_ok=True)
+    staged_files, duplicates = [], 0
+    for file in files:
+        if isinstance(file.stream, StagedFile) and file.stream.duplicate:
+            duplicates += 1
+            continue
+        # Staged under a unique name, so concurrent uploads cannot collide
+        staged_files.append((save_upload(file, directory),
+                             secure_filename(file.filename)))
+
+    return queue_staged(staged_files, upload_batch_id, user_id,
+                        duplicates=duplicates)
+
+
+def queue_staged(staged, upload_batch_id, user_id, duplicates=0):
+    """Count staged files against an upload batch and queue them for ingest
+
+    Args:
+        staged (list): (staged path, filename) pairs
+        upload_batch_id (uuid.UUID): batch to count these files against
+        user_id: uploader ID
+        duplicates (int, optional): files already found to be duplicates
+            while they were received. Defaults to 0.
+
+    Returns:
+        uuid.UUID: the upload batch ID
+    """
+    from app.tasks import ingest_staged_files
+
+    update_upload_batch(upload_batch_id, user_id=user_id,
+                        staged=len(staged) + duplicates, duplicate=duplicates)
+    if staged:
+        ingest_staged_files.delay(upload_batch_id=upload_batch_id.hex,
+                                  user_id=str(user_id), staged_files=staged)
+    return upload_batch_id
+
+
+class StagedFile:
+    """Spool file for an uploaded file, written in the staging area
+
+    The first bytes received are peeked for the SOP Instance UID. If that
+    image is already in the database, the rest of the upload is discarded
+    instead of being written to disk.
+    """
+
+    def __init__(self, directory):
+        fd, self.name = tempfile.mkstemp(dir=directory, prefix='upload-')
+        self._file = os.fdopen(fd, 'w+b')
+        self._prefix = b''
+        self.image_uid = None
+        self.duplicate = False
+
+    def write(self, data):
+        if self.duplicate:
+            return len(data)
+        if self.image_uid is None and len(self._prefix) < PEEK_BYTES:
+            self._prefix += data
+            self.image_uid = peek_image_uid(self._prefix)
+            if self.image_uid is not None and db.session.query(
+                    db.exists().where(Image.uid == self.image_uid)).scalar():
+                self.duplicate = True
+                self._file.truncate(0)
+                return len(data)
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+
+class StagingRequest(Request):
+    """Request that spools uploaded files straight into the staging area
+
+    Uploads are written once, to a unique file on the same filesystem as
+    UPLOADED_PATH, and ingest renames them into place. Spool files left
+    behind when the request closes are removed.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        staged_file = StagedFile(current_app.config['STAGING_PATH'])
+        self.staged_files.append(staged_file)
+        return staged_file
+
+    @cached_property
+    def staged_files(self):
+        return []
+
+    def close(self):
+        super().close()
+        for staged_file in self.staged_files:
+            staged_file.close()
+            if os.path.exists(staged_file.name):
+                os.remove(staged_file.name)
+
+
+def _new_receipt(path, filename, error=None):
+    return {'path': path, 'filename': filename, 'image_uid': None,
+            'image_id': None, 'series_id': None, 'study_id': None,
+            'directory': None, 'duplicate': False, 'error': error}
+
+
+def update_upload_batch(upload_batch_id, user_id=None, **counts):
+    """Create an upload batch or atomically add to its counts"""
+    stmt = insert(UploadBatch.__table__).values(
+        id=upload_batch_id, user_id=user_id, **counts)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['id'],
+        set_={name: UploadBatch.__table__.c[name] + stmt.excluded[name]
+              for name in counts})
+    db.session.execute(stmt)
+    db.session.commit()
+
+
+def count_receipts(receipts):
+    """Count ingest receipts by outcome: parsed, duplicate or failed"""
+    counts = {'parsed': 0, 'duplicate': 0, 'failed': 0}
+    for receipt in receipts:
+        if receipt['duplicate']:
+            counts['duplicate'] += 1
+        elif receipt['error']:
+            counts['failed'] += 1
+        else:
+            counts['parsed'] += 1
+    return counts
+
+
+def receipt_json(receipt):
+    """Summarise an ingest receipt as a JSON-serialisable dict"""
+    return {
+        'filename': receipt['filename'],
+        'image_uid': receipt['image_uid'],
+        'image_id': receipt['image_id'] and str(receipt['image_id']),
+        'series_id': receipt['series_id'] and str(receipt['series_id']),
+        'study_id': receipt['study_id'] and str(receipt['study_id']),
+        'duplicate': receipt['duplicate'],
+        'error': receipt['error'] and str(receipt['error']),
+    }
+
+
+# DICOM keywords read at ingest, keyed by the header field they populate
+HEADER_TAGS = {
+    'image_uid': 'SOPInstanceUID',  # (0008,0018)
+    'series_uid': 'SeriesInstanceUID',  # (0020,000E)
+    'study_uid': 'StudyInstanceUID',  # (0020,000D)
+    'study_description': 'StudyDescription',  # (0008,1030)
+    'series_description': 'SeriesDescription',  # (0008,103E)
+    'series_date': 'SeriesDate',  # (0008,0021)
+    'series_time': 'SeriesTime',  # (0008,0031)
+    'study_date': 'StudyDate',  # (0008,0020)
+    'institution': 'InstitutionName',  # (0008,0080)
+    'manufacturer': 'Manufacturer',  # (0008,0070)
+    'model': 'ManufacturerModelName',  # (0008,1090)
+    'station_name': 'StationName',  # (0008,1010)
+    'accession_number': 'AccessionNumber',  # (0008,0050)
+}
+# Header fields that may be absent from the file
+OPTIONAL_HEADER_FIELDS = {'study_description'}
+# DICOM keywords stored as a snapshot in Image.header, where present
+SNAPSHOT_TAGS = [
+    'SOPClassUID', 'ImageType', 'Modality', 'AcquisitionDate',
+    'AcquisitionTime', 'SoftwareVersions', 'DeviceSerialNumber',
+    'BodyPartExamined', 'ProtocolName', 'SequenceName', 'ScanningSequence',
+    'SequenceVariant', 'MRAcquisitionType', 'SliceThickness',
+    'RepetitionTime', 'EchoTime', 'InversionTime', 'NumberOfAverages',
+    'ImagingFrequency', 'EchoNumbers', 'MagneticFieldStrength',
+    'SpacingBetweenSlices', 'EchoTrainLength', 'PixelBandwidth',
+    'ReceiveCoilName', 'TransmitCoilName', 'AcquisitionMatrix',
+    'InPlanePhaseEncodingDirection', 'FlipAngle', 'SeriesNumber',
+    'AcquisitionNumber', 'InstanceNumber', 'ImagePositionPatient',
+    'ImageOrientationPatient', 'SliceLocation', 'NumberOfFrames', 'Rows',
+    'Columns', 'PixelSpacing',
+]
+# Acquisition parameters shared by a series, summarised in Series.acquisition
+SERIES_SUMMARY_TAGS = [
+    'Modality', 'ProtocolName', 'SequenceName', 'ScanningSequence',
+    'SequenceVariant', 'MRAcquisitionType', 'SliceThickness',
+    'RepetitionTime', 'EchoTime', 'InversionTime', 'NumberOfAverages',
+    'ImagingFrequency', 'MagneticFieldStrength', 'SpacingBetweenSlices',
+    'EchoTrainLength', 'PixelBandwidth', 'ReceiveCoilName',
+    'TransmitCoilName', 'AcquisitionMatrix', 'InPlanePhaseEncodingDirection',
+    'FlipAngle', 'Rows', 'Columns', 'PixelSpacing',
+]
+# Elements are stored in tag order, nothing after this one needs parsing
+LAST_HEADER_TAG = max(tag_for_keyword(keyword) for keyword in
+                      list(HEADER_TAGS.values()) + SNAPSHOT_TAGS)
+
+
+# Bytes of an upload searched for its SOP Instance UID before it is written
+PEEK_BYTES = 64 * 1024
+
+
+def _after_header_tags(tag, vr, length):
+    # Stop condition for read_partial, module level so it can be pickled
+    return tag > LAST_HEADER_TAG
+
+
+def peek_image_uid(prefix):
+    """Find the SOP Instance UID in the first bytes of a DICOM file
+
+    Returns:
+        str: the UID, or None if it is not wholly contained in prefix
+    """
+    complete = []
+
+    def after_sop_instance_uid(tag, vr, length):
+        # Only trust the UID once the next element has been reached,
+        # otherwise its value may have been truncated
+        if tag > 0x00080018:
+            complete.append(True)
+            return True
+        return False
+
     try:
-        filesystem_dir = ingest_image(secure_path)
-        permanent_path = os.path.join(filesystem_dir, filename)
-        shutil.move(secure_path, permanent_path)
-        flash(f'{filename} file has been uploaded successfully!', 'success')
-    except ImageExistsError:
-        os.remove(secure_path)
-        flash(f'{filename} file has already been uploaded!', 'danger')
+        dcm = read_partial(BytesIO(prefix), stop_when=after_sop_instance_uid,
+                           force=True, specific_tags=['SOPInstanceUID'])
+    except Exception:
+        return None
+    if not complete or 'SOPInstanceUID' not in dcm:
+        return None
+    return str(dcm.SOPInstanceUID)
+
+
+def read_header(file_path, full=False):
+    """Parse the DICOM header fields needed to populate the database
+
+    Only the elements in HEADER_TAGS and SNAPSHOT_TAGS are decoded, the
+    latter into a JSON-serialisable ``snapshot``, and parsing stops after
+    the last of them, so large private vendor blocks (e.g. Siemens CSA
+    headers in group 0029) are never read. If any required element is
+    missing from the selective read, the whole header is read instead.
+
+    Args:
+        file_path (str): path to a DICOM file
+        full (bool, optional): read the whole header. Defaults to False.
+
+    Returns:
+        dict: header values keyed by database field
+    """
+    # Load in the DICOM header into a pydicom Dataset
+    if full:
+        dcm = pydicom.dcmread(file_path, force=True, stop_before_pixels=True)
+    else:
+        with open(file_path, 'rb') as fp:
+            dcm = read_partial(fp, stop_when=_after_header_tags, force=True,
+                               specific_tags=list(HEADER_TAGS.values()) + SNAPSHOT_TAGS)
+    if not full and any(keyword not in dcm for field, keyword in HEADER_TAGS.items()
+                        if field not in OPTIONAL_HEADER_FIELDS):
+        return read_header(file_path, full=True)
+
+    header = {field: dcm.get(keyword) for field, keyword in HEADER_TAGS.items()}
+    # Raise for missing required elements, as attribute access would
+    missing = [HEADER_TAGS[field] for field, value in header.items()
+               if value is None and field not in OPTIONAL_HEADER_FIELDS]
+    if missing:
+        raise AttributeError(f"Missing DICOM elements: {', '.join(missing)}")
+
+    if header['study_description'] is None:
+        header['study_description'] = "Not available"
+    header['series_datetime'] = datetime.strptime("-".join(
+        [header.pop('series_date'), header.pop('series_time').split('.')[0]]),
+        '%Y%m%d-%H%M%S')
+    # Plain strings rather than pydicom's str subclasses (UID etc.)
+    header = {field: str(value) if isinstance(value, str) else value
+              for field, value in header.items()}
+    header['snapshot'] = {
+        keyword: json_value(dcm.get(keyword)) for keyword in
+        list(HEADER_TAGS.values()) + SNAPSHOT_TAGS if dcm.get(keyword) is not None}
+    return header
+
+
+def json_value(value):
+    """Normalise a pydicom element value to a JSON-serialisable type"""
+    if isinstance(value, (list, MultiValue)):
+        return [json_value(item) for item in value]
+    if isinstance(value, (DSfloat, DSdecimal, float)):
+        return float(value)
+    if isinstance(value, (IS, int)):
+        return int(value)
+    if isinstance(value, bytes):
+        return None
+    return str(value)
 
 
 # Upload images one at a time and parse metadata from DICOM header
 def ingest_image(file_path):
-    try:
-        # Load in the DICOM header into a pydicom Dataset
-        dcm = pydicom.read_file(file_path, force=True,
-                                                stop_before_pixels=True)
-
-        # Parse the relevant fields into variables
-        image_uid = dcm.SOPInstanceUID
-        # Ensure that image is not yet in database
-        image_exists = db.session.query(db.exists().where(Image.uid == image_uid)).scalar()
-        if image_exists:
-            current_app.logger.info('Image already exists in database')
-            raise ImageExistsError(f"UID: {image_uid}")
-
-        # Collect relevant pieces of information from DICOM header
-        series_uid = dcm.SeriesInstanceUID
-        study_uid = dcm.StudyInstanceUID
-        # description = f"{dcm.StudyDescription}: {dcm.SeriesDescription}"
-        try:
-            study_description = dcm.StudyDescription
-        except AttributeError:
-            study_description = "Not available"
-        filename = os.path.basename(file_path)
-
-        # 0020 Study date
-        study_date = dcm.StudyDate
-        # 0030 study time
-        study_time = dcm.StudyTime
-        institution = dcm.InstitutionName
-        # 0070 manufacturer
-        manufacturer = dcm.Manufacturer
-        # (0008,1090)	LO	Manufacturer's Model Name
-        model = dcm[0x00081090].value
-        station_name = dcm.StationName
-        # 0050 accession number
-        accession_number = dcm.AccessionNumber
-        # print({"institution": institution,
-        #        "manufacturer": manufacturer,
-        #        "model": model,
-        #        "study_date": study_date,
-        #        "study_time": study_time,
-        #        "station_name": station_name,
-        #        "accession_number": accession_number
-        #        })
-
-        # Save the image data into the corresponding tables:
-        # 0. Device:
-        try:
-            device_id = Device.query.where(Device.institution == institution
-                ).where(Device.manufacturer == manufacturer
-                ).where(Device.device_model == model
-                ).where(Device.station_name == station_name).first().id
-        except:
-            new_device = Device(
-                institution=institution, manufacturer=manufacturer,
-                device_model=model, station_name=station_name)
-            new_device.save()
-            db.session.add(new_device)
-            device_id = new_device.id
-        #TODO remove in production
-        print("device id:", device_id)
-        
-        # 1. Study:
-        try:
-            study_id = Study.query.filter_by(uid=study_uid).first().id
-        except:
-            new_study = Study(uid=study_uid,
-                              description=study_description,
-                              study_date=study_date)
-            new_study.save()
-            db.session.add(new_study)
-            study_id = new_study.id
-        #TODO remove in production
-        print("study id:", study_id)
-        
-        # 2. Series:
+    receipt = ingest_images([file_path])[0]
+    if receipt['error']:
+        raise receipt['error']
+    if receipt['duplicate']:
+        current_app.logger.info('Image already exists in database')
+        raise ImageExistsError(f"UID: {receipt['image_uid']}")
+    return receipt['directory']
+
+
+def ingest_images(file_paths, user_id=None, copy=False, filenames=None,
+                  workers=None, known_uids=None, on_batch=None):
+    """Ingest DICOM files in batches, one database transaction per batch
+
+    Files are split into batches bounded by INGEST_BATCH_FILES and
+    INGEST_BATCH_BYTES. The headers of each batch are parsed in a pool of
+    worker processes, then every Device, Study and Series is upserted once
+    per distinct key, the Image rows are bulk-inserted with
+    ``ON CONFLICT DO NOTHING`` and the batch is committed once. New files
+    are moved (or copied) into their series folder after the commit, as are
+    duplicates of stored images whose file is missing.
+
+    Args:
+        file_paths (list): paths to DICOM files
+        user_id (optional): uploader ID. Defaults to the logged in user.
+        copy (bool, optional): copy rather than move files into the
+            series folder. Defaults to False.
+        filenames (list, optional): names to store the files under, when
+            they differ from the file path. Defaults to None.
+        workers (int, optional): number of header parsing workers.
+            Defaults to INGEST_WORKERS.
+        known_uids (set, optional): SOP Instance UIDs already stored, which
+            are marked as duplicates without querying the database. Newly
+            ingested UIDs are added to it. Defaults to None.
+        on_batch (callable, optional): called with the receipts of each
+            batch once it is stored. Defaults to None.
+
+    Returns:
+        list: one receipt dict per file path, in the same order
+    """
+    if user_id is None and has_request_context():
+        user_id = current_user.get_id()
+    if filenames is None:
+        filenames = [os.path.basename(file_path) for file_path in file_paths]
+    if workers is None:
+        workers = current_app.config['INGEST_WORKERS']
+
+    receipts = []
+    with header_executor(workers, len(file_paths)) as executor:
+        for batch in split_batches(list(zip(file_paths, filenames)),
+                                   current_app.config['INGEST_BATCH_FILES'],
+                                   current_app.config['INGEST_BATCH_BYTES']):
+            batch_paths = [file_path for file_path, _ in batch]
+            headers = read_headers(batch_paths, executor)
+            batch_receipts = []
+            for (file_path, filename), (header, error) in zip(batch, headers):
+                receipt = _new_receipt(file_path, filename, error)
+                if error is not None:
+                    current_app.logger.warning(
+                        f"Could not parse {file_path}: {error}")
+                elif known_uids is not None and header['image_uid'] in known_uids:
+                    receipt.update(image_uid=header['image_uid'], duplicate=True)
+                else:
+                    receipt['header'] = header
+                    receipt['image_uid'] = header['image_uid']
+                batch_receipts.append(receipt)
+            batch_receipts = _store_batch(batch_receipts, user_id, copy)
+            if known_uids is not None:
+                known_uids.update(receipt['image_uid'] for receipt in batch_receipts
+                                  if receipt['image_id'] is not None)
+            if on_batch is not None:
+                on_batch(batch_receipts)
+            receipts.extend(batch_receipts)
+
+    return receipts
+
+
+def split_batches(items, max_files, max_bytes):
+    """Split (path, filename) pairs into batches bounded by count and size
+
+    A single file larger than max_bytes still forms a batch of its own.
+    """
+    batch, batch_bytes = [], 0
+    for item in items:
         try:
-            series_id = Series.query.filter_by(uid=series_uid).first().id
-        except:
-            series_datetime = datetime.strptime("-".join(
-                                [dcm.SeriesDate, dcm.SeriesTime.split('.')[0]]
-                                    ), '%Y%m%d-%H%M%S')
-
-            new_series = Series(
-                uid=series_uid, description=dcm.SeriesDescription,
-                user_id=current_user.get_id(), device_id=device_id,
-                study_id=study_id, series_datetime=series_datetime)
-            new_series.save()
-            db.session.add(new_series)
-            series_id = new_series.id
-        #TODO remove in production
-        print("series id:", series_id)
-
-        # 3. Image:
-        new_image = Image(
-            uid=image_uid, series_id=series_id, filename=filename,
-            accession_number=accession_number)
-        new_image.save()
-        db.session.add(new_image)
-        #TODO remove in production
-        print("new image id:", new_image.id)
-
-        # Commit all changes to the database
-        db.session.commit()
-
-        # Store file in series/image folder
-        series_folder = Series.query.filter_by(uid=series_uid).first().filesystem_key
-        directory = os.path.join(current_app.config['UPLOADED_PATH'], series_folder)
-        os.makedirs(directory, exist_ok=True)
-
-        return directory
+            size = os.path.getsize(item[0])
+        except OSError:
+            size = 0
+        if batch and (len(batch) >= max_files or batch_bytes + size > max_bytes):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(item)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+@contextmanager
+def header_executor(workers, n_files):
+    """Pool for parsing DICOM headers, or None when parsing serially
 
+    Header parsing is pure Python, so processes are used to sidestep the
+    GIL. Daemonic processes, such as Celery prefork children, cannot start
+    their own, so those fall back to threads.
+    """
+    if workers <= 1 or n_files <= 1:
+        yield None
+        return
+    workers = min(workers, n_files)
+    if multiprocessing.current_process().daemon:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    with executor:
+        yield executor
+
+
+def read_headers(file_paths, executor=None):
+    """Parse DICOM headers, in parallel if an executor is given
+
+    Returns:
+        list: (header, error) tuples in the same order as file_paths
+    """
+    if executor is None:
+        return [_read_header_safely(file_path) for file_path in file_paths]
+    return list(executor.map(_read_header_safely, file_paths,
+                             chunksize=max(1, len(file_paths) // 32)))
+
+
+def _read_header_safely(file_path):
+    # Module level so that it can be pickled for a process pool
+    try:
+        return read_header(file_path), None
     except Exception as e:
-        raise
+        return None, e
+
+
+def _store_batch(receipts, user_id, copy):
+    """Write the parsed receipts of one batch to the database and filesystem"""
+    # Ensure that images are not yet in database, nor repeated in this batch
+    parsed = [receipt for receipt in receipts if 'header' in receipt]
+    uids = {receipt['image_uid'] for receipt in parsed}
+    stored = {uid: (series_id, filename) for uid, series_id, filename in db.session.query(
+        Image.uid, Image.series_id, Image.filename).filter(Image.uid.in_(uids))} if uids else {}
+    seen_uids = set(stored)
+    new_receipts, missing_files = [], []
+    for receipt in parsed:
+        if receipt['image_uid'] in seen_uids:
+            receipt['duplicate'] = True
+            # A stored image whose file is missing, such as when a previous
+            # attempt failed between its commit and moving its files, gets
+            # this copy of it instead
+            if receipt['image_uid'] in stored:
+                series_id, filename = stored.pop(receipt['image_uid'])
+                if not os.path.exists(os.path.join(
+                        current_app.config['UPLOADED_PATH'], series_id.hex, filename)):
+                    missing_files.append((receipt, series_id, filename))
+        else:
+            seen_uids.add(receipt['image_uid'])
+            new_receipts.append(receipt)
+
+    # Per-batch caches of database ids, keyed by DICOM identifiers. Rows are
+    # upserted in sorted key order, so that concurrent batches with overlapping
+    # UIDs lock them in the same order and cannot deadlock
+    device_cache, study_cache, series_cache = {}, {}, {}
+    headers = [receipt['header'] for receipt in new_receipts]
+    for header in sorted(headers, key=_device_key):
+        _get_or_create_device(header, device_cache)
+    for header in sorted(headers, key=lambda header: header['study_uid'] or ''):
+        _get_or_create_study(header, study_cache)
+    for header in sorted(headers, key=lambda header: header['series_uid'] or ''):
+        _get_or_create_series(header, series_cache, user_id,
+                              device_cache[_device_key(header)],
+                              study_cache[header['study_uid']])
+    image_rows = []
+    for receipt in new_receipts:
+        header = receipt.pop('header')
+        device_id = _get_or_create_device(header, device_cache)
+        study_id = _get_or_create_study(header, study_cache)
+        series_id = _get_or_create_series(header, series_cache,
+                                          user_id, device_id, study_id)
+
+        image_id = uuid.uuid4()
+        image_rows.append({
+            'id': image_id, 'uid': header['image_uid'],
+            'series_id': series_id, 'filename': receipt['filename'],
+            'accession_number': header['accession_number'],
+            'header': header['snapshot']})
+        receipt.update(image_id=image_id, series_id=series_id,
+                       study_id=study_id)
+    for receipt in receipts:
+        receipt.pop('header', None)
+
+    if image_rows:
+        image_rows.sort(key=lambda row: row['uid'] or '')
+        # A concurrent upload may have stored some of these images since the
+        # check above, in which case they are skipped and marked as duplicates
+        stmt = insert(Image.__table__).values(image_rows
+            ).on_conflict_do_nothing(index_elements=['uid']
+            ).returning(Image.__table__.c.uid)
+        inserted_uids = {uid for (uid,) in db.session.execute(stmt)}
+        for receipt in new_receipts:
+            if receipt['image_uid'] not in inserted_uids:
+                receipt.update(duplicate=True, image_id=None)
+        new_receipts = [receipt for receipt in new_receipts
+                        if not receipt['duplicate']]
+    # Commit all changes to the database
+    db.session.commit()
+
+    # Store files in series/image folders
+    for receipt in new_receipts:
+        receipt['directory'] = _store_file(receipt['path'], receipt['series_id'],
+                                           receipt['filename'], copy)
+    for receipt, series_id, filename in missing_files:
+        _store_file(receipt['path'], series_id, filename, copy)
+
+    current_app.logger.info(
+        f"Ingested {len(new_receipts)} of {len(receipts)} files")
+    if missing_files:
+        current_app.logger.warning(
+            f"Restored the missing files of {len(missing_files)} stored images")
+    return receipts
+
+
+def _store_file(file_path, series_id, filename, copy):
+    # Move or copy a file into its series folder, returning the folder
+    directory = os.path.join(current_app.config['UPLOADED_PATH'], series_id.hex)
+    os.makedirs(directory, exist_ok=True)
+    permanent_path = os.path.join(directory, filename)
+    if copy:
+        shutil.copy(file_path, permanent_path)
+    else:
+        shutil.move(file_path, permanent_path)
+    return directory
+
+
+def _upsert(model, values, conflict_columns):
+    """Insert a row, or return the id of the row it conflicts with
+
+    Uses PostgreSQL ``INSERT ... ON CONFLICT DO UPDATE`` so that concurrent
+    uploads of the same Study/Series/Device resolve to a single row. The
+    no-op update is what makes ``RETURNING`` yield the existing id.
+    """
+    stmt = insert(model.__table__).values(**values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=conflict_columns,
+        set_={conflict_columns[0]: stmt.excluded[conflict_columns[0]]}
+    ).returning(model.__table__.c.id)
+    return db.session.execute(stmt).scalar()
+
+
+def _device_key(header):
+    # Unique constraints treat NULLs as distinct, so store blanks instead
+    return tuple(header[field] or '' for field in
+                 ('institution', 'manufacturer', 'model', 'station_name'))
+
+
+def _get_or_create_device(header, cache):
+    key = _device_key(header)
+    if key not in cache:
+        cache[key] = _upsert(Device, dict(
+            institution=key[0], manufacturer=key[1],
+            device_model=key[2], station_name=key[3]),
+            ['institution', 'manufacturer', 'device_model', 'station_name'])
+    return cache[key]
+
+
+def _get_or_create_study(header, cache):
+    key = header['study_uid']
+    if key not in cache:
+        cache[key] = _upsert(Study, dict(
+            uid=key, description=header['study_description'],
+            study_date=header['study_date']), ['uid'])
+    return cache[key]
+
+
+def _get_or_create_series(header, cache, user_id, device_id, study_id):
+    key = header['series_uid']
+    if key not in cache:
+        cache[key] = _upsert(Series, dict(
+            uid=key, description=header['series_description'],
+            series_datetime=header['series_datetime'],
+            acquisition={keyword: header['snapshot'][keyword]
+                         for keyword in SERIES_SUMMARY_TAGS
+                         if keyword in header['snapshot']},
+            user_id=user_id, device_id=device_id,
+            study_id=study_id), ['uid'])
+    return cache[key]
 
 
 def locate_image_files(filesystem_key, filename=False):
@@ -157,7 +785,73 @@ def locate_image_files(filesystem_key, filename=False):
         image_files = os.listdir(folder)
     else:
         image_files = [os.path.join(folder, file) for file in os.listdir(folder)]
-    
+
+    return image_files
+
+
+def image_manifest(series_ids):
+    """Image rows of some series, in the order their files are processed
+
+    Series are kept in the given order and their images are ordered by
+    InstanceNumber, then SliceLocation, from the stored header snapshots.
+
+    Returns:
+        list: (id, series_id, filename) rows
+    """
+    series_ids = [uuid.UUID(str(series_id)) for series_id in series_ids]
+    series_order = {series_id: index for index, series_id in enumerate(series_ids)}
+    rows = db.session.query(
+        Image.id, Image.series_id, Image.filename,
+        Image.header['InstanceNumber'], Image.header['SliceLocation'],
+    ).filter(Image.series_id.in_(series_ids)).all()
+    rows.sort(key=lambda row: (series_order[row[1]], _sort_number(row[3]),
+                               _sort_number(row[4]), row[2]))
+    return [(image_id, series_id, filename) for image_id, series_id, filename, _, _ in rows]
+
+
+def _sort_number(value):
+    # Sort key of a numeric header value, unknown values last
+    try:
+        return (0, float(value))
+    except (TypeError, ValueError):
+        return (1, 0.0)
+
+
+def manifest_version(series_ids, manifest=None):
+    """Version of the set of images in some series
+
+    It changes whenever an image is added to or removed from the series.
+    """
+    if manifest is None:
+        manifest = image_manifest(series_ids)
+    image_ids = sorted(image_id.hex for image_id, _, _ in manifest)
+    return hashlib.sha1(''.join(image_ids).encode()).hexdigest()
+
+
+def resolve_image_files(series_ids, version=None):
+    """Paths of the images of some series under this node's UPLOADED_PATH
+
+    Args:
+        series_ids (list): series whose images are processed, in order
+        version (str, optional): manifest version the images were listed
+            at when the job was queued. Defaults to None.
+
+    Raises:
+        ManifestError: if the series have changed since version, have no
+            images, or images are missing from storage
+    """
+    manifest = image_manifest(series_ids)
+    if not manifest:
+        raise ManifestError(f"No images found for series {series_ids}")
+    if version is not None and manifest_version(series_ids, manifest) != version:
+        raise ManifestError(f"Images of series {series_ids} changed since the job was queued")
+
+    image_files = [os.path.join(current_app.config['UPLOADED_PATH'], series_id.hex, filename)
+                   for _, series_id, filename in manifest]
+    missing = [file_path for file_path in image_files if not os.path.exists(file_path)]
+    if missing:
+        raise ManifestError(f"{len(missing)} images are missing from storage, "
+                            f"including {missing[0]}")
     return image_files
 
 
@@ -0,0 +1,112 @@
+"""Content-addressed cache of task results.
+
+A Report is reused instead of recomputed when it was produced from the same
+image content, by the same task with the same arguments and the same
+hazenlib version. Image content is identified by the SHA-256 of each file,
+computed by the worker the first time the image is processed and stored on
+its Image row, so that later runs and submissions only read the stored
+checksums.
+"""
+import hashlib
+import json
+import os
+import uuid
+
+from sqlalchemy import and_, bindparam
+
+from app import db
+from app.models import Image, Report
+
+
+def file_checksum(file_path):
+    """SHA-256 hex digest of a file"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def content_hash(checksums):
+    """Hash of a set of images, independent of their order"""
+    return hashlib.sha256('\n'.join(sorted(checksums)).encode()).hexdigest()
+
+
+def cache_key(image_hash, task_name, task_kwargs, hazen_version):
+    """Key identifying the result of a task run"""
+    payload = json.dumps([image_hash, task_name, task_kwargs or {}, hazen_version],
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def stored_content_hash(series_ids):
+    """Content hash of the images of some series, from stored checksums
+
+    Returns:
+        str: the hash, or None if any image has not been checksummed yet
+    """
+    checksums = [checksum for (checksum,) in db.session.query(Image.checksum).filter(
+        Image.series_id.in_(series_ids))]
+    if not checksums or None in checksums:
+        return None
+    return content_hash(checksums)
+
+
+def files_content_hash(image_files):
+    """Content hash of image files, from the checksums stored on their Image rows
+
+    Files are expected in the series folder layout, UPLOADED_PATH/<series id>/<filename>.
+    Only files whose Image row has no checksum yet are read and hashed, and
+    their checksums are recorded.
+    """
+    locations = {}
+    for file_path in image_files:
+        try:
+            series_id = uuid.UUID(os.path.basename(os.path.dirname(file_path)))
+        except ValueError:
+            series_id = None
+        locations[file_path] = (series_id, os.path.basename(file_path))
+
+    series_ids = {series_id for series_id, _ in locations.values() if series_id is not None}
+    stored = {(series_id, filename): checksum for series_id, filename, checksum in
+              db.session.query(Image.series_id, Image.filename, Image.checksum).filter(
+                  Image.series_id.in_(series_ids))} if series_ids else {}
+
+    checksums, rows = [], []
+    for file_path, location in locations.items():
+        checksum = stored.get(location)
+        if checksum is None:
+            checksum = file_checksum(file_path)
+            if location in stored:
+                rows.append({'b_series_id': location[0], 'b_filename': location[1],
+                             'b_checksum': checksum})
+        checksums.append(checksum)
+    if rows:
+        table = Image.__table__
+        db.session.execute(table.update().where(and_(
+            table.c.series_id == bindparam('b_series_id'),
+            table.c.filename == bindparam('b_filename'),
+            table.c.checksum.is_(None))).values(checksum=bindparam('b_checksum')), rows)
+    return content_hash(checksums)
+
+
+def find_cached_report(key):
+    """Most recent report stored under a cache key, or None"""
+    if key is None:
+        return None
+    return Report.query.filter_by(cache_key=key).order_by(Report.created_at.desc()).first()
+
+
+def invalidate_stale_reports(hazen_version):
+    """Stop reusing reports produced by another hazenlib version
+
+    The reports are kept, only their cache key is cleared.
+
+    Returns:
+        int: number of reports invalidated
+    """
+    count = Report.query.filter(
+        Report.cache_key.isnot(None), Report.hazen_version != hazen_version
+    ).update({'cache_key': None}, synchronize_session=False)
+    db.session.commit()
+    return count
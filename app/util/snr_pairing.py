@@ -0,0 +1,96 @@
+"""Pairing of series for subtraction SNR measurements.
+
+The SNR task subtracts two repeated acquisitions. Selected series are paired
+using their stored header metadata: both series of a pair come from the same
+device, were acquired with the same sequence parameters over the same slice
+positions, and the second was acquired shortly after the first. Among the
+candidates, series are paired in order of acquisition time.
+"""
+from datetime import datetime
+
+from app import db
+from app.models import Image, Series
+
+# Acquisition parameters that must be equal for two series to be paired
+PAIRING_TAGS = [
+    'Modality', 'ProtocolName', 'SequenceName', 'ScanningSequence',
+    'SequenceVariant', 'MRAcquisitionType', 'SliceThickness',
+    'RepetitionTime', 'EchoTime', 'InversionTime', 'NumberOfAverages',
+    'FlipAngle', 'PixelBandwidth', 'ReceiveCoilName', 'AcquisitionMatrix',
+    'InPlanePhaseEncodingDirection', 'Rows', 'Columns', 'PixelSpacing',
+]
+
+
+def _normalise(value, decimals=3):
+    # Comparable form of a header value, insensitive to float noise
+    if isinstance(value, float):
+        return round(value, decimals)
+    if isinstance(value, list):
+        return tuple(_normalise(item, decimals) for item in value)
+    return value
+
+
+def pairing_key(series):
+    """Device, sequence parameters and slice positions a pair must share"""
+    acquisition = series['acquisition'] or {}
+    return (series['device_id'],
+            tuple(_normalise(acquisition.get(keyword)) for keyword in PAIRING_TAGS),
+            series['slice_positions'])
+
+
+def pair_series(series_list, max_interval):
+    """Pair series for subtraction SNR
+
+    Args:
+        series_list (list): dicts with the ``id``, ``device_id``,
+            ``series_datetime``, ``acquisition`` parameters and
+            ``slice_positions`` of each series
+        max_interval (float): largest number of seconds between the
+            acquisitions of a pair
+
+    Returns:
+        tuple: list of (first, second) series id pairs in acquisition order,
+            and list of the ids of series that could not be paired
+    """
+    groups = {}
+    for series in series_list:
+        groups.setdefault(pairing_key(series), []).append(series)
+
+    pairs, unpaired = [], []
+    for group in groups.values():
+        group.sort(key=lambda series: series['series_datetime'] or datetime.max)
+        index = 0
+        while index < len(group):
+            first = group[index]
+            second = group[index + 1] if index + 1 < len(group) else None
+            if second is not None and _interval(first, second) <= max_interval:
+                pairs.append((first, second))
+                index += 2
+            else:
+                unpaired.append(first['id'])
+                index += 1
+    pairs.sort(key=lambda pair: pair[0]['series_datetime'])
+    return [(first['id'], second['id']) for first, second in pairs], unpaired
+
+
+def _interval(first, second):
+    # Seconds between two acquisitions, infinite if either time is unknown
+    if first['series_datetime'] is None or second['series_datetime'] is None:
+        return float('inf')
+    return (second['series_datetime'] - first['series_datetime']).total_seconds()
+
+
+def series_pairing_info(series_ids):
+    """Metadata used for pairing, from the stored Series and Image headers"""
+    positions = {}
+    for series_id, position, location in db.session.query(
+            Image.series_id, Image.header['ImagePositionPatient'],
+            Image.header['SliceLocation']).filter(Image.series_id.in_(series_ids)):
+        position = _normalise(position, 1) if position is not None else _normalise(location, 1)
+        positions.setdefault(series_id, set()).add(position)
+
+    return [{'id': series.id, 'device_id': series.device_id,
+             'series_datetime': series.series_datetime,
+             'acquisition': series.acquisition,
+             'slice_positions': frozenset(positions.get(series.id, ()))}
+            for series in Series.query.filter(Series.id.in_(series_ids))]
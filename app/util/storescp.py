@@ -0,0 +1,124 @@
+"""DICOM Storage SCP, so that modalities and PACS can push QA series directly.
+
+Incoming instances are written to the staging area as they arrive, without
+decoding the dataset, and are ingested in batches of INGEST_BATCH_FILES per
+association: one transaction per batch, with the files renamed into their
+series folder like any other upload. Whatever is left of a batch is ingested
+when the association is released or aborted.
+"""
+import os
+import tempfile
+import threading
+
+from flask import current_app
+from pydicom.filebase import DicomFileLike
+from pydicom.filewriter import write_file_meta_info
+from pynetdicom import AE, AllStoragePresentationContexts, evt
+from werkzeug.utils import secure_filename
+
+from app import db
+from app.util.im2db_utils import ingest_staged, count_receipts
+
+# C-STORE status codes
+SUCCESS = 0x0000
+OUT_OF_RESOURCES = 0xA700
+
+
+class StorageSCP:
+    """Accept C-STORE requests and ingest the received instances
+
+    Args:
+        app: Flask app, whose context is pushed in association threads
+        user_id (optional): ID of the user recorded as the uploader
+    """
+
+    def __init__(self, app, user_id=None):
+        self.app = app
+        self.user_id = user_id
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @property
+    def handlers(self):
+        return [(evt.EVT_C_STORE, self.handle_store),
+                (evt.EVT_RELEASED, self.handle_closed),
+                (evt.EVT_ABORTED, self.handle_closed)]
+
+    def handle_store(self, event):
+        """Write one instance to the staging area as received"""
+        with self.app.app_context():
+            try:
+                staged_path = self._write_instance(event)
+            except OSError as e:
+                current_app.logger.error(f"Could not store instance: {e}")
+                return OUT_OF_RESOURCES
+            filename = secure_filename(f'{event.request.AffectedSOPInstanceUID}.dcm')
+            with self._lock:
+                pending = self._pending.setdefault(event.assoc, [])
+                pending.append((staged_path, filename))
+                if len(pending) < current_app.config['INGEST_BATCH_FILES']:
+                    return SUCCESS
+                batch = self._pending.pop(event.assoc)
+            self.ingest(batch)
+        return SUCCESS
+
+    def handle_closed(self, event):
+        """Ingest the rest of the association's instances"""
+        with self._lock:
+            batch = self._pending.pop(event.assoc, [])
+        if batch:
+            with self.app.app_context():
+                self.ingest(batch)
+
+    def ingest(self, batch):
+        """Ingest a batch of staged instances in one transaction
+
+        Header parsing is kept serial, associations are network bound and
+        forking from their threads is unsafe.
+        """
+        try:
+            receipts = ingest_staged(batch, self.user_id, workers=1)
+        except Exception:
+            db.session.rollback()
+            current_app.logger.exception(
+                f"Could not ingest {len(batch)} received instances")
+            return None
+        finally:
+            db.session.remove()
+        current_app.logger.info(
+            f"Received {len(batch)} instances: {count_receipts(receipts)}")
+        return receipts
+
+    @staticmethod
+    def _write_instance(event):
+        # The encoded dataset is written as sent, behind the file meta
+        # information, rather than decoded and re-encoded
+        fd, staged_path = tempfile.mkstemp(dir=current_app.config['STAGING_PATH'],
+                                           prefix='upload-')
+        with os.fdopen(fd, 'wb') as staged:
+            staged.write(b'\x00' * 128 + b'DICM')
+            write_file_meta_info(DicomFileLike(staged), event.file_meta)
+            staged.write(event.request.DataSet.getvalue())
+        return staged_path
+
+
+def start_storescp(app, user_id=None, ae_title=None, port=None, block=True):
+    """Start the Storage SCP
+
+    Args:
+        app: Flask app
+        user_id (optional): uploader ID. Defaults to None.
+        ae_title (str, optional): Defaults to STORESCP_AE_TITLE.
+        port (int, optional): Defaults to STORESCP_PORT.
+        block (bool, optional): serve in the calling thread. Defaults to True.
+
+    Returns:
+        the running pynetdicom server when not blocking
+    """
+    ae_title = ae_title or app.config['STORESCP_AE_TITLE']
+    port = app.config['STORESCP_PORT'] if port is None else port
+    scp = StorageSCP(app, user_id)
+    ae = AE(ae_title=ae_title)
+    ae.supported_contexts = AllStoragePresentationContexts
+    app.logger.info(f"Storage SCP {ae_title} listening on port {port}")
+    return ae.start_server(('', port), block=block, evt_handlers=scp.handlers)
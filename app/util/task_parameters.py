@@ -0,0 +1,64 @@
+"""Task arguments entered as optional command arguments, and parameter sweeps.
+
+Arguments are written as on the hazen command line, ``--name=value``. A value
+may list several comma-separated values, such as ``--roi_size=10,20,30``, in
+which case the task is evaluated over every combination of the listed values
+as a parameter sweep.
+"""
+import ast
+import itertools
+import shlex
+
+
+class ParameterError(ValueError): pass
+
+
+def _value(text):
+    # Python literal if it is one, such as 3, 2.5 or None, otherwise a string
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def parse_task_variable(task_variable, registered_task):
+    """Parse optional command arguments of a task
+
+    Args:
+        task_variable (str): arguments, such as ``--measured_slice_width=3,4``
+        registered_task (RegisteredTask): task the arguments are passed to
+
+    Returns:
+        dict: list of values by parameter name
+
+    Raises:
+        ParameterError: if an argument is malformed or not a task parameter
+    """
+    try:
+        tokens = shlex.split(task_variable or '')
+    except ValueError as e:
+        raise ParameterError(f"Invalid arguments: {e}")
+
+    values = {}
+    for token in tokens:
+        name, separator, text = token.lstrip('-').partition('=')
+        name = name.replace('-', '_')
+        if not separator or not name or not text:
+            raise ParameterError(f"Arguments are written --name=value, not {token}")
+        if name not in registered_task.parameters:
+            raise ParameterError(
+                f"{registered_task.name} has no {name} parameter, it accepts: "
+                f"{', '.join(registered_task.parameters) or 'none'}")
+        values[name] = [_value(item) for item in text.split(',')]
+    return values
+
+
+def parameter_grid(values):
+    """Every combination of parameter values
+
+    Returns:
+        list: task arguments dicts, a single empty dict without parameters
+    """
+    names = sorted(values)
+    return [dict(zip(names, combination))
+            for combination in itertools.product(*(values[name] for name in names))]
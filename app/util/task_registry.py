@@ -0,0 +1,155 @@
+"""Registry of the hazenlib task classes, built once per process.
+
+Every module in ``hazenlib.tasks`` is imported when the registry is built and
+its task class is resolved, so running a job only needs a dictionary lookup.
+The Celery worker builds the registry in its parent process at start-up,
+before the pool is forked, so that children share the imported modules.
+"""
+import copy
+import importlib
+import inspect
+import pkgutil
+
+from flask import current_app
+
+
+class UnknownTaskError(Exception): pass
+
+
+class ChunkMergeError(Exception): pass
+
+
+class RegisteredTask:
+    """A hazenlib task class and the parameters of its constructor and run()
+
+    Tasks measuring each image independently opt in to map-reduce execution
+    with a chunk size, see TASK_CHUNK_SIZE: series with more images are then
+    split into chunks run in parallel, and their results merged.
+    """
+
+    # Constructor arguments supplied by the app, never by users
+    RESERVED_PARAMETERS = ('self', 'input_data', 'data_paths', 'report', 'report_dir')
+
+    def __init__(self, name, cls, chunk_size=None):
+        self.name = name
+        self.cls = cls
+        self.chunk_size = chunk_size
+        self.signature = inspect.signature(cls)
+        self.run_signature = inspect.signature(cls.run)
+        self.parameters = {
+            param_name: parameter
+            for signature in (self.signature, self.run_signature)
+            for param_name, parameter in signature.parameters.items()
+            if param_name not in self.RESERVED_PARAMETERS and parameter.kind in (
+                parameter.POSITIONAL_OR_KEYWORD, parameter.KEYWORD_ONLY)}
+
+    def __repr__(self):
+        return f'<RegisteredTask {self.name}: {self.cls.__name__}{self.signature}>'
+
+    def create(self, image_files, **kwargs):
+        """Instantiate the task on a list of image files"""
+        return self.cls(input_data=image_files, report=True, **kwargs)
+
+    def split_kwargs(self, kwargs):
+        """Task arguments split between the constructor and run()"""
+        run_kwargs = {name: value for name, value in kwargs.items()
+                      if name in self.run_signature.parameters}
+        init_kwargs = {name: value for name, value in kwargs.items() if name not in run_kwargs}
+        return init_kwargs, run_kwargs
+
+    def execute(self, image_files, **kwargs):
+        """Run the task on a list of image files, returning its result dict"""
+        init_kwargs, run_kwargs = self.split_kwargs(kwargs)
+        return self.create(image_files, **init_kwargs).run(**run_kwargs)
+
+    def merge(self, results):
+        """Merge the results of the task run on consecutive chunks of a series
+
+        Raises:
+            ChunkMergeError: if chunks measured the same value, the task does
+                not measure each image independently
+        """
+        measurement = {}
+        for result in results:
+            _merge_measurement(measurement, result['measurement'])
+        return {'measurement': measurement,
+                'report_image': [file for result in results for file in result['report_image']]}
+
+
+def _merge_measurement(merged, measurement, path=()):
+    # Measurements are keyed by image, nested dicts under the same key are combined
+    for key, value in measurement.items():
+        if key not in merged:
+            merged[key] = copy.deepcopy(value)
+        elif isinstance(value, dict) and isinstance(merged[key], dict):
+            _merge_measurement(merged[key], value, path + (key,))
+        else:
+            raise ChunkMergeError(
+                f"{'/'.join(map(str, path + (key,)))} was measured by several chunks, "
+                f"the task cannot be split into chunks")
+
+
+_registry = None
+_import_errors = {}
+
+
+def load_task_registry():
+    """Import every hazenlib task module and resolve its task class
+
+    Modules that cannot be imported, or that do not define exactly one
+    identifiable task class, are left out and their error is kept so that
+    requesting them later explains why.
+
+    Returns:
+        dict: RegisteredTask by task name
+    """
+    global _registry
+    from hazenlib import tasks as hazen_tasks
+
+    registry = {}
+    for _, name, _ in pkgutil.iter_modules(hazen_tasks.__path__):
+        try:
+            module = importlib.import_module(f'hazenlib.tasks.{name}')
+            registry[name] = RegisteredTask(name, _task_class(module, name),
+                                            current_app.config['TASK_CHUNK_SIZE'].get(name))
+        except Exception as e:
+            _import_errors[name] = e
+            current_app.logger.warning(f'Could not load hazenlib task {name}: {e}')
+    _registry = registry
+    current_app.logger.info(f'Loaded hazenlib tasks: {", ".join(sorted(registry))}')
+    return registry
+
+
+def task_registry():
+    """The registry, built on first use in processes that did not preload it"""
+    if _registry is None:
+        load_task_registry()
+    return _registry
+
+
+def get_task(task_name):
+    """Look up a registered task by name
+
+    Raises:
+        UnknownTaskError: if there is no such task or it failed to load
+    """
+    try:
+        return task_registry()[task_name]
+    except KeyError:
+        if task_name in _import_errors:
+            raise UnknownTaskError(
+                f'Task {task_name} could not be loaded: {_import_errors[task_name]}')
+        raise UnknownTaskError(f'Unknown task {task_name}')
+
+
+def _task_class(module, name):
+    # The class named after the module, otherwise the only class it defines
+    classes = {cls.__name__: cls for _, cls in inspect.getmembers(
+        module, lambda x: inspect.isclass(x) and x.__module__ == module.__name__)}
+    for class_name in (name.capitalize(), name.title().replace('_', '')):
+        if class_name in classes:
+            return classes[class_name]
+    if len(classes) == 1:
+        return next(iter(classes.values()))
+    raise UnknownTaskError(
+        f'Task {name} has {len(classes)} class definitions: {sorted(classes)}')
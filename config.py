@@ -1,4 +1,5 @@
 import os
+from kombu import Queue
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 
@@ -34,6 +35,10 @@ class Config:
         CELERY_BROKER_URL = 'amqp://localhost'  # for RabbitMQ
         CELERY_RESULT_BACKEND = 'rpc://'  # for RabbitMQ
 
+    # Redis pub/sub relaying job progress to the browser, the broker if it is Redis
+    EVENTS_REDIS_URL = os.environ.get('EVENTS_REDIS_URL') or (
+        CELERY_BROKER_URL if (CELERY_BROKER_URL or '').startswith('redis') else None)
+
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
@@ -48,12 +53,73 @@ class Config:
     LANGUAGES = ['en-GB', 'fr']
 
     UPLOADED_PATH = os.path.join(basedir, 'uploads')
+    # Uploads are held here until ingested, on the same filesystem as UPLOADED_PATH
+    STAGING_PATH = os.path.join(UPLOADED_PATH, 'staging')
+    # Ingest uploads in the Celery worker instead of the web request
+    INGEST_ASYNC = os.environ.get('INGEST_ASYNC') is not None
+    # Processes parsing DICOM headers in parallel during ingest
+    INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS') or os.cpu_count() or 1)
+    # Files ingested per database transaction, bounded by count and total size
+    INGEST_BATCH_FILES = int(os.environ.get('INGEST_BATCH_FILES') or 500)
+    INGEST_BATCH_BYTES = int(os.environ.get('INGEST_BATCH_BYTES') or 512 * 1024 ** 2)
     ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'ima', 'dcm'}
 
-    DROPZONE_MAX_FILE_SIZE = 5
+    DROPZONE_MAX_FILE_SIZE = 2048
     DROPZONE_PARALLEL_UPLOADS = 1
     DROPZONE_MAX_FILES = 100
     DROPZONE_UPLOAD_ON_CLICK = True
     DROPZONE_ALLOWED_FILE_TYPE = 'application/dicom, .IMA, .dcm'
     DROPZONE_ALLOWED_FILE_CUSTOM = True
+    # Large files are uploaded in chunks, sent in parallel and assembled on the server
+    UPLOAD_CHUNK_SIZE = 8 * 1024 ** 2
+    # Seconds after which a partial upload is considered abandoned
+    CHUNK_UPLOAD_EXPIRY = 24 * 60 * 60
+
+    # DICOM Storage SCP receiving images pushed from modalities and PACS
+    STORESCP_AE_TITLE = os.environ.get('STORESCP_AE_TITLE') or 'HAZEN'
+    STORESCP_PORT = int(os.environ.get('STORESCP_PORT') or 11112)
+
+    # hazenlib tasks are routed to a Celery queue by cost class, each class
+    # with its soft and hard time limits in seconds
+    TASK_COST_CLASSES = {
+        'light': {'queue': 'interactive', 'soft_time_limit': 5 * 60, 'time_limit': 6 * 60},
+        'heavy': {'queue': 'bulk', 'soft_time_limit': 60 * 60, 'time_limit': 65 * 60},
+    }
+    # Cost class of the hazenlib tasks, others are light
+    TASK_COST_CLASS = {'acr_uniformity': 'heavy', 'relaxometry': 'heavy', 'snr_map': 'heavy'}
+    TASK_COST_CLASS_DEFAULT = 'light'
+    # Queues consumed by workers started without -Q, uploads use the default queue
+    CELERY_QUEUES = [Queue(name, routing_key=name) for name in
+                     ['celery'] + sorted({cost['queue'] for cost in TASK_COST_CLASSES.values()})]
+
+    # hazenlib tasks measuring each image independently, run on series with more
+    # images than their chunk size as chunks in parallel, then merged into one report.
+    # Their measurements must be keyed by image (the default HazenTask.key), as
+    # ghosting's are not, chunks measuring the same key fail the merge
+    TASK_CHUNK_SIZE = {'slice_width': 16, 'spatial_resolution': 16, 'uniformity': 16}
+
+    # Largest number of seconds between the two acquisitions of an SNR pair
+    SNR_PAIR_MAX_INTERVAL = 30 * 60
+
+    # Threads running the tasks of a protocol job, 1 runs them one after another.
+    # Tasks drawing report figures with pyplot are not all safe to run in threads.
+    PROTOCOL_THREADS = int(os.environ.get('PROTOCOL_THREADS') or 1)
+
+    # Bytes of decoded DICOM datasets kept by each worker process, 0 disables the cache
+    DATASET_CACHE_BYTES = int(os.environ.get('DATASET_CACHE_BYTES') or 1024 ** 3)
+    # Optional folder, ideally on tmpfs, where decoded pixels are memory-mapped
+    # and shared by the processes of a worker
+    DATASET_CACHE_PIXEL_STORE = os.environ.get('DATASET_CACHE_PIXEL_STORE')
+    DATASET_CACHE_PIXEL_STORE_BYTES = int(os.environ.get('DATASET_CACHE_PIXEL_STORE_BYTES') or 4 * 1024 ** 3)
+
+    # Seconds task results are kept in the result backend. Reports are stored in
+    # the database, results only hold their reference until chords have completed.
+    CELERY_TASK_RESULT_EXPIRES = int(os.environ.get('CELERY_RESULT_EXPIRES') or 24 * 60 * 60)
+    # Results of fire-and-forget tasks (ingest, archive import, upload expiry and
+    # batch run callbacks) are not stored, unless KEEP_TASK_RESULTS is set
+    IGNORE_TASK_RESULTS = os.environ.get('KEEP_TASK_RESULTS') is None
+
+    CELERYBEAT_SCHEDULE = {
+        'expire-uploads': {'task': 'app.tasks.expire_uploads', 'schedule': 60 * 60},
+    }
 
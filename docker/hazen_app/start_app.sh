@@ -1,7 +1,21 @@
 #!/bin/bash
 
-# Start the first process
-celery -A hazen.worker worker &
+# Start the Celery workers, one of them with the periodic clean-up of partial
+# uploads. WORKER_POOLS lists dedicated pools as queue:concurrency, such as
+# "interactive:4 bulk:1 celery:1", otherwise one worker consumes every queue
+if [ -n "$WORKER_POOLS" ]; then
+    beat="-B"
+    for pool in $WORKER_POOLS; do
+        queue="${pool%%:*}"
+        celery -A hazen.worker worker -Q "$queue" -c "${pool##*:}" -n "$queue@%h" $beat &
+        beat=""
+    done
+else
+    celery -A hazen.worker worker -B &
+fi
+
+# Start the DICOM Storage SCP, for images pushed from modalities and PACS
+flask storescp &
 
 # Start the second process
 python hazen.py &
@@ -1,7 +1,7 @@
 import os
-import pkgutil
-import importlib
+import time
 
+import click
 from flask import current_app
 
 from app import db, create_app, create_celery_app
@@ -16,14 +16,19 @@ app.secret_key = app.config['SECRET_KEY']
 worker = create_celery_app(app)  # a Celery object
 
 
+def task_routing(task_name):
+    """Cost class and queue of a hazenlib task, from TASK_COST_CLASS"""
+    cost_class = app.config['TASK_COST_CLASS'].get(
+        task_name, app.config['TASK_COST_CLASS_DEFAULT'])
+    return {'cost_class': cost_class,
+            'queue': app.config['TASK_COST_CLASSES'][cost_class]['queue']}
+
+
 def register_tasks_in_db():
-    from hazenlib import tasks as hazen_tasks
-    # TODO: Change to read from hazenlib classes
-    tasks = {f'{modname}': importlib.import_module(
-        f'hazenlib.tasks.{modname}') for importer, modname, ispkg in
-        pkgutil.iter_modules(hazen_tasks.__path__)}
+    from app.util.task_registry import task_registry
 
     with app.app_context():
+        tasks = dict(task_registry())
         # Check if hazen task already exists in database
         stored_tasks = Task.query.all()
 
@@ -31,10 +36,12 @@ def register_tasks_in_db():
             if stored_task.name in tasks.keys():
                 _ = tasks.pop(stored_task.name)
                 current_app.logger.info(f'{stored_task.name} already exists in db')
+            # Follow changes to the configured cost classes
+            stored_task.update(commit=False, **task_routing(stored_task.name))
 
         # Add new tasks to database
         for name, obj in tasks.items():
-            new_task = Task(name=name)
+            new_task = Task(name=name, **task_routing(name))
             new_task.save()
         db.session.commit()
 
@@ -43,6 +50,77 @@ def register_tasks_in_db():
 register_tasks_in_db()
 
 
+@app.cli.command('import-dicom')
+@click.argument('folder', type=click.Path(exists=True, file_okay=False))
+@click.option('--username', help='User to record as the uploader.')
+@click.option('--workers', type=int, help='Header parsing workers. Defaults to INGEST_WORKERS.')
+@click.option('--batch-size', type=int, help='Files per transaction. Defaults to INGEST_BATCH_FILES.')
+@click.option('--move', is_flag=True, help='Move files into storage instead of copying them.')
+def import_dicom(folder, username, workers, batch_size, move):
+    """Import every DICOM file under FOLDER
+
+    Images whose SOP Instance UID is already stored are skipped without
+    being copied, so an interrupted import can simply be run again.
+    """
+    from app.util.im2db_utils import ingest_images, count_receipts
+
+    user_id = None
+    if username is not None:
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.BadParameter(f'No user named {username}', param_hint='--username')
+        user_id = user.id
+    if batch_size is not None:
+        app.config['INGEST_BATCH_FILES'] = batch_size
+
+    file_paths = []
+    for root, _, filenames in os.walk(folder):
+        for filename in sorted(filenames):
+            if filename.upper() == 'DICOMDIR' or filename.startswith('.'):
+                continue
+            file_paths.append(os.path.join(root, filename))
+
+    # Preloaded once, instead of checking each file against the database
+    known_uids = {uid for (uid,) in db.session.query(Image.uid)}
+    click.echo(f'Found {len(file_paths)} files, {len(known_uids)} images already stored')
+
+    counts = {'parsed': 0, 'duplicate': 0, 'failed': 0}
+    start = time.perf_counter()
+
+    def report_progress(receipts):
+        for key, count in count_receipts(receipts).items():
+            counts[key] += count
+        done = sum(counts.values())
+        rate = done / (time.perf_counter() - start)
+        click.echo(f"{done}/{len(file_paths)} files: {counts['parsed']} new, "
+                   f"{counts['duplicate']} known, {counts['failed']} failed "
+                   f"({rate:.1f} files/s)")
+
+    ingest_images(file_paths, user_id=user_id, copy=not move, workers=workers,
+                  known_uids=known_uids, on_batch=report_progress)
+
+    elapsed = time.perf_counter() - start
+    click.echo(f"Imported {counts['parsed']} images in {elapsed:.1f}s "
+               f"({counts['parsed'] / elapsed if elapsed else 0:.1f} images/s)")
+
+
+@app.cli.command('storescp')
+@click.option('--ae-title', help='AE title. Defaults to STORESCP_AE_TITLE.')
+@click.option('--port', type=int, help='Port to listen on. Defaults to STORESCP_PORT.')
+@click.option('--username', help='User to record as the uploader.')
+def storescp(ae_title, port, username):
+    """Receive images pushed by modalities and PACS over DICOM C-STORE"""
+    from app.util.storescp import start_storescp
+
+    user_id = None
+    if username is not None:
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.BadParameter(f'No user named {username}', param_hint='--username')
+        user_id = user.id
+    start_storescp(app, user_id=user_id, ae_title=ae_title, port=port)
+
+
 @app.shell_context_processor
 def make_shell_context():
     return {'db': db, 'User': User, 'Device': Device,
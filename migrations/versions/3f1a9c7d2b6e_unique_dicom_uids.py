@@ -0,0 +1,104 @@
+"""unique DICOM UIDs and device identity
+
+Revision ID: 3f1a9c7d2b6e
+Revises: 1544418d922f
+Create Date: 2026-10-18 09:12:40.118204
+
+"""
+import os
+import uuid
+
+from alembic import op
+from flask import current_app
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1a9c7d2b6e'
+down_revision = '1544418d922f'
+branch_labels = None
+depends_on = None
+
+
+def _find_duplicates(table, key_columns, where='TRUE'):
+    # Temporary table mapping each duplicate row to the lowest id sharing its key
+    op.execute(f"""
+        CREATE TEMPORARY TABLE {table}_duplicates AS
+        SELECT id, keep_id FROM (
+            SELECT id, first_value(id) OVER (
+                PARTITION BY {', '.join(key_columns)} ORDER BY id) AS keep_id
+            FROM {table} WHERE {where}) AS ranked
+        WHERE id <> keep_id""")
+
+
+def _merge_duplicates(table, children):
+    # Repoint the foreign keys of child rows to the kept rows, then delete the duplicates
+    for child_table, column in children:
+        op.execute(f"""
+            UPDATE {child_table} SET {column} = duplicates.keep_id
+            FROM {table}_duplicates AS duplicates
+            WHERE {child_table}.{column} = duplicates.id""")
+    op.execute(f"""
+        DELETE FROM {table} USING {table}_duplicates AS duplicates
+        WHERE {table}.id = duplicates.id""")
+    op.execute(f"DROP TABLE {table}_duplicates")
+
+
+def _merge_duplicate_uids():
+    """Merge the rows stored more than once by the ingest before unique UIDs
+
+    Each set of duplicates is merged into its lowest id. Among duplicate
+    images, the one in the series that is kept is kept, and the files of the
+    images that only exist in a merged series are moved to the kept series
+    folder. Files of deleted duplicate images are left on disk.
+    """
+    _find_duplicates('device', ['institution', 'manufacturer', 'device_model', 'station_name'])
+    _merge_duplicates('device', [('series', 'device_id')])
+    _find_duplicates('study', ['uid'], where='uid IS NOT NULL')
+    _merge_duplicates('study', [('series', 'study_id')])
+
+    _find_duplicates('series', ['uid'], where='uid IS NOT NULL')
+    op.execute("""
+        DELETE FROM image USING (
+            SELECT image.id, row_number() OVER (
+                PARTITION BY image.uid
+                ORDER BY series_duplicates.id IS NOT NULL, image.id) AS rank
+            FROM image
+            LEFT JOIN series_duplicates ON series_duplicates.id = image.series_id
+            WHERE image.uid IS NOT NULL) AS ranked
+        WHERE image.id = ranked.id AND ranked.rank > 1""")
+    moved = op.get_bind().execute(sa.text("""
+        SELECT image.filename, image.series_id, series_duplicates.keep_id
+        FROM image JOIN series_duplicates ON series_duplicates.id = image.series_id""")).fetchall()
+    _merge_duplicates('series', [('image', 'series_id'), ('report', 'series_id')])
+
+    uploaded_path = current_app.config['UPLOADED_PATH']
+    for filename, series_id, keep_id in moved:
+        source = os.path.join(uploaded_path, uuid.UUID(str(series_id)).hex, filename)
+        destination = os.path.join(uploaded_path, uuid.UUID(str(keep_id)).hex, filename)
+        if os.path.exists(source) and not os.path.exists(destination):
+            os.renames(source, destination)
+
+
+def upgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    # Blank device fields are stored as empty strings so that the unique
+    # constraint also matches devices with missing DICOM tags
+    for column in ['institution', 'manufacturer', 'device_model', 'station_name']:
+        op.execute(f"UPDATE device SET {column} = '' WHERE {column} IS NULL")
+    _merge_duplicate_uids()
+    op.create_unique_constraint('uq_device_identity', 'device',
+                                ['institution', 'manufacturer', 'device_model', 'station_name'])
+    op.create_index(op.f('ix_image_uid'), 'image', ['uid'], unique=True)
+    op.create_index(op.f('ix_series_uid'), 'series', ['uid'], unique=True)
+    op.create_index(op.f('ix_study_uid'), 'study', ['uid'], unique=True)
+    # ### end Alembic commands ###
+
+
+def downgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.drop_index(op.f('ix_study_uid'), table_name='study')
+    op.drop_index(op.f('ix_series_uid'), table_name='series')
+    op.drop_index(op.f('ix_image_uid'), table_name='image')
+    op.drop_constraint('uq_device_identity', 'device', type_='unique')
+    # ### end Alembic commands ###
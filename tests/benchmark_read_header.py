@@ -0,0 +1,50 @@
+"""Micro-benchmark of selective against full DICOM header reads at ingest.
+
+Usage:
+    python -m tests.benchmark_read_header <folder> [--repeat=<n>]
+
+Point it at a folder of vendor files, e.g. Siemens images carrying CSA
+headers, to see the effect of skipping private blocks.
+"""
+import argparse
+import os
+import time
+
+from app.util.im2db_utils import HEADER_TAGS, read_header
+
+
+def full_read(file_path):
+    # Header read as done before selective parsing was introduced
+    return read_header(file_path, full=True)
+
+
+def time_reader(reader, file_paths, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for file_path in file_paths:
+            reader(file_path)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('folder')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    file_paths = [os.path.join(root, name)
+                  for root, _, names in os.walk(args.folder) for name in names]
+    print(f"{len(file_paths)} files, {len(HEADER_TAGS)} tags, best of {args.repeat}")
+
+    full = time_reader(full_read, file_paths, args.repeat)
+    selective = time_reader(read_header, file_paths, args.repeat)
+    for label, seconds in [('full header', full), ('selective tags', selective)]:
+        print(f"{label:>15}: {seconds:.3f}s "
+              f"({len(file_paths) / seconds:.0f} files/s)")
+    print(f"{'speed-up':>15}: {full / selective:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+
+from pydicom.data import get_testdata_file
+
+from app.util.dataset_cache import DatasetCache, HEADER_BYTES, PixelStore
+
+
+class DatasetCacheCase(unittest.TestCase):
+
+    def setUp(self):
+        self.file_path = get_testdata_file('MR_small.dcm')
+
+    def test_datasets_are_read_once(self):
+        cache = DatasetCache(64 * 1024 ** 2)
+        first = cache.read(self.file_path)
+        second = cache.read(self.file_path)
+        self.assertEqual(cache.counts(), {'hits': 1, 'misses': 1})
+        self.assertTrue((first.pixel_array == second.pixel_array).all())
+
+    def test_copies_are_private(self):
+        cache = DatasetCache(64 * 1024 ** 2)
+        first = cache.read(self.file_path)
+        first.PatientName = 'Changed'
+        self.assertNotEqual(cache.read(self.file_path).PatientName, 'Changed')
+        # Pixels modified in place by one task are not seen by others
+        original = first.pixel_array[0, 0]
+        first.pixel_array[0, 0] = original + 1
+        self.assertEqual(cache.read(self.file_path).pixel_array[0, 0], original)
+
+    def test_datasets_keep_pixel_data(self):
+        cache = DatasetCache(64 * 1024 ** 2)
+        cache.read(self.file_path)
+        dataset = cache.read(self.file_path)
+        with open(self.file_path, 'rb') as file:
+            self.assertIn(dataset.PixelData, file.read())
+        # Changing PixelData decodes it again
+        dataset.PixelData = bytes(len(dataset.PixelData))
+        self.assertFalse(dataset.pixel_array.any())
+
+    def test_lru_is_bounded(self):
+        cache = DatasetCache(HEADER_BYTES)
+        with tempfile.TemporaryDirectory() as folder:
+            file_paths = []
+            for index in range(3):
+                file_path = os.path.join(folder, f'{index}.dcm')
+                with open(self.file_path, 'rb') as source, open(file_path, 'wb') as copy:
+                    copy.write(source.read())
+                file_paths.append(file_path)
+                cache.read(file_path)
+            self.assertEqual(len(cache._entries), 1)
+            cache.read(file_paths[0])
+            self.assertEqual(cache.counts(), {'hits': 0, 'misses': 4})
+
+    def test_pixel_store_is_shared(self):
+        with tempfile.TemporaryDirectory() as folder:
+            DatasetCache(64 * 1024 ** 2, PixelStore(folder, 1024 ** 3)).read(self.file_path)
+            # Another process finds the decoded pixels in the store
+            dataset = DatasetCache(64 * 1024 ** 2, PixelStore(folder, 1024 ** 3)).read(self.file_path)
+            self.assertEqual(dataset.pixel_array.shape, (dataset.Rows, dataset.Columns))
+            self.assertEqual(len(os.listdir(folder)), 1)
+            # Mapped copy-on-write, the stored pixels are left unchanged
+            original = dataset.pixel_array[0, 0]
+            dataset.pixel_array[0, 0] = original + 1
+            store = PixelStore(folder, 1024 ** 3)
+            self.assertEqual(DatasetCache(64 * 1024 ** 2, store).read(self.file_path)
+                             .pixel_array[0, 0], original)
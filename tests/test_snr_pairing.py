@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta
+import unittest
+
+from app.util.snr_pairing import pair_series
+
+
+def make_series(series_id, minutes, device_id='scanner', echo_time=30.0,
+                positions=(0.0, 5.0, 10.0)):
+    return {'id': series_id, 'device_id': device_id,
+            'series_datetime': datetime(2022, 10, 18, 9) + timedelta(minutes=minutes),
+            'acquisition': {'SequenceName': 'se2d1', 'RepetitionTime': 1000.0,
+                            'EchoTime': echo_time, 'PixelSpacing': [0.9765625, 0.9765625]},
+            'slice_positions': frozenset(positions)}
+
+
+class SNRPairingCase(unittest.TestCase):
+
+    def test_weekly_pairs(self):
+        # Two back-to-back acquisitions per week, selected in any order
+        series_list = []
+        for week in range(10):
+            series_list.append(make_series(f'{week}b', week * 7 * 24 * 60 + 3))
+            series_list.append(make_series(f'{week}a', week * 7 * 24 * 60))
+        pairs, unpaired = pair_series(series_list, max_interval=30 * 60)
+        self.assertEqual(pairs, [(f'{week}a', f'{week}b') for week in range(10)])
+        self.assertEqual(unpaired, [])
+
+    def test_sequence_and_position_must_match(self):
+        series_list = [
+            make_series('a', 0),
+            make_series('b', 2, echo_time=80.0),
+            make_series('c', 4, positions=(0.0, 5.0)),
+            make_series('d', 6, device_id='other'),
+            make_series('e', 8),
+        ]
+        pairs, unpaired = pair_series(series_list, max_interval=30 * 60)
+        self.assertEqual(pairs, [('a', 'e')])
+        self.assertCountEqual(unpaired, ['b', 'c', 'd'])
+
+    def test_interval(self):
+        series_list = [make_series('a', 0), make_series('b', 45),
+                       make_series('c', 50)]
+        pairs, unpaired = pair_series(series_list, max_interval=30 * 60)
+        self.assertEqual(pairs, [('b', 'c')])
+        self.assertEqual(unpaired, ['a'])
+
+    def test_float_noise(self):
+        first, second = make_series('a', 0), make_series('b', 1)
+        second['acquisition']['PixelSpacing'] = [0.97656250001, 0.9765625]
+        pairs, _ = pair_series([first, second], max_interval=30 * 60)
+        self.assertEqual(pairs, [('a', 'b')])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,53 @@
+import unittest
+
+from app.util.task_parameters import parse_task_variable, parameter_grid, ParameterError
+from app.util.task_registry import RegisteredTask
+
+
+class Task:
+    def __init__(self, roi_size=20, **kwargs):
+        pass
+
+    def run(self, measured_slice_width=None):
+        pass
+
+
+class HazenTask:
+    # Shaped like hazenlib.HazenTask, with the arguments supplied by the app
+    def __init__(self, input_data, report=False, report_dir='hazen_reports', roi_size=20):
+        pass
+
+    def run(self):
+        pass
+
+
+class TaskParametersCase(unittest.TestCase):
+
+    def setUp(self):
+        self.task = RegisteredTask('task', Task)
+
+    def test_single_parameter_set(self):
+        values = parse_task_variable('--measured_slice_width=3', self.task)
+        self.assertEqual(parameter_grid(values), [{'measured_slice_width': 3}])
+        self.assertEqual(parameter_grid(parse_task_variable('', self.task)), [{}])
+
+    def test_sweep_grid(self):
+        values = parse_task_variable('--roi_size=10,20 --measured_slice_width=2.5,5', self.task)
+        grid = parameter_grid(values)
+        self.assertEqual(len(grid), 4)
+        self.assertIn({'roi_size': 10, 'measured_slice_width': 5}, grid)
+        self.assertEqual(self.task.split_kwargs(grid[0]),
+                         ({'roi_size': 10}, {'measured_slice_width': 2.5}))
+
+    def test_unknown_parameter(self):
+        with self.assertRaises(ParameterError):
+            parse_task_variable('--slice=3', self.task)
+        with self.assertRaises(ParameterError):
+            parse_task_variable('--roi_size', self.task)
+
+    def test_reserved_parameter(self):
+        task = RegisteredTask('hazen_task', HazenTask)
+        self.assertEqual(list(task.parameters), ['roi_size'])
+        for task_variable in ('--report=False', '--report_dir=/tmp', '--input_data=x'):
+            with self.assertRaises(ParameterError):
+                parse_task_variable(task_variable, task)
@@ -0,0 +1,37 @@
+import unittest
+
+from app.util.task_registry import RegisteredTask, ChunkMergeError
+
+
+class Uniformity:
+    def __init__(self, **kwargs):
+        pass
+
+    def run(self):
+        pass
+
+
+class ChunkMergeCase(unittest.TestCase):
+
+    def test_chunk_results_are_merged_in_order(self):
+        task = RegisteredTask('uniformity', Uniformity, chunk_size=2)
+        partials = [
+            {'measurement': {'slice_1': {'uniformity': 0.91}, 'slice_2': {'uniformity': 0.92}},
+             'report_image': ['slice_1.png', 'slice_2.png']},
+            {'measurement': {'slice_3': {'uniformity': 0.93}},
+             'report_image': ['slice_3.png']},
+        ]
+        merged = task.merge(partials)
+        self.assertEqual(list(merged['measurement']), ['slice_1', 'slice_2', 'slice_3'])
+        self.assertEqual(merged['report_image'], ['slice_1.png', 'slice_2.png', 'slice_3.png'])
+
+    def test_colliding_chunk_results_fail(self):
+        task = RegisteredTask('uniformity', Uniformity, chunk_size=2)
+        partials = [
+            {'measurement': {'uniformity': {'mean': 0.91}, 'slices': 2}, 'report_image': []},
+            {'measurement': {'uniformity': {'mean': 0.93}, 'slices': 1}, 'report_image': []},
+        ]
+        with self.assertRaises(ChunkMergeError):
+            task.merge(partials)
+        # Values of the first chunk are left as they were
+        self.assertEqual(partials[0]['measurement']['uniformity'], {'mean': 0.91})